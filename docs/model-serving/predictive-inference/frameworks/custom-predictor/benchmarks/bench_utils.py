@@ -0,0 +1,198 @@
+import base64
+import importlib
+import io
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+import urllib.request
+from typing import Callable, Dict, List
+
+from PIL import Image
+
+EXAMPLES_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+INPUT_PATH = os.path.join(EXAMPLES_DIR, "input.json")
+SERVER_MODULES = {"rest": "model.py", "grpc": "model_grpc.py", "ray": "model_remote.py"}
+IMAGE_PIPELINE_DIR = os.path.join(
+    EXAMPLES_DIR, "..", "..", "..", "inferencegraph", "image-pipeline"
+)
+
+
+def import_example(variant: str, module: str):
+    """Import a module of an example directory (rest, grpc or ray), next to
+    the serving_utils module they share."""
+    for path in [EXAMPLES_DIR, os.path.join(EXAMPLES_DIR, variant)]:
+        if path not in sys.path:
+            sys.path.insert(0, path)
+    # The example modules parse the command line at import time, hide the
+    # benchmark arguments from them.
+    argv, sys.argv = sys.argv, sys.argv[:1]
+    try:
+        return importlib.import_module(module)
+    finally:
+        sys.argv = argv
+
+
+def random_weights(model_cls):
+    """Return a subclass of an example model that loads randomly initialized
+    AlexNet weights, so the benchmarks do not need to download anything."""
+    from torchvision import models
+
+    class RandomWeightsModel(model_cls):
+        def __init__(self, *args, **kwargs):
+            # The pipeline of the model captures models.alexnet when it is created.
+            alexnet = models.alexnet
+            models.alexnet = lambda *args, **kwargs: alexnet()
+            try:
+                super().__init__(*args, **kwargs)
+            finally:
+                models.alexnet = alexnet
+
+    return RandomWeightsModel
+
+
+def rest_app(model):
+    """Return a FastAPI app serving the REST example model on the KServe v1
+    endpoints, for in-process benchmarks without a model server."""
+    from fastapi import FastAPI
+    from kserve.model_repository import ModelRepository
+    from kserve.protocol.dataplane import DataPlane
+    from kserve.protocol.rest.v1_endpoints import register_v1_endpoints
+
+    repository = ModelRepository()
+    repository.update(model)
+    app = FastAPI()
+    app.add_middleware(import_example("rest", "serving_utils").OctetStreamMiddleware)
+    register_v1_endpoints(app, DataPlane(model_registry=repository), None)
+    return app
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_server(
+    variant: str, http_port: int, extra_args: List[str], env=None, grpc_port: int = None
+) -> subprocess.Popen:
+    """Start the model server of an example directory (rest, grpc or ray)
+    serving custom-model on http_port."""
+    command = [
+        sys.executable, SERVER_MODULES[variant], "--model_name", "custom-model",
+        "--http_port", str(http_port), "--grpc_port", str(grpc_port or free_port()),
+    ] + extra_args
+    # The examples import serving_utils from the parent directory, the image
+    # build copies it next to them instead.
+    env = dict(os.environ if env is None else env)
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [EXAMPLES_DIR, env.get("PYTHONPATH")]))
+    return subprocess.Popen(
+        command,
+        cwd=os.path.join(EXAMPLES_DIR, variant),
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+
+
+def wait_ok(process: subprocess.Popen, url: str, deadline: float) -> bool:
+    """Poll url until it responds with 200 OK, or the process exited or the
+    time.monotonic() deadline passed."""
+    while time.monotonic() < deadline and process.poll() is None:
+        try:
+            with urllib.request.urlopen(url, timeout=1) as response:
+                if response.status == 200:
+                    return True
+        except OSError:
+            pass
+        time.sleep(0.02)
+    return False
+
+
+def children(pid: int) -> List[int]:
+    with open(f"/proc/{pid}/task/{pid}/children") as children_file:
+        return [int(child) for child in children_file.read().split()]
+
+
+def process_tree(pid: int) -> List[int]:
+    """Return pid and all of its descendants, e.g. the Ray processes started by
+    a model server. Only available on Linux."""
+    pids = [pid]
+    for parent in pids:
+        try:
+            pids.extend(children(parent))
+        except OSError:
+            pass
+    return pids
+
+
+def sample_image_bytes() -> bytes:
+    with open(INPUT_PATH) as json_file:
+        data = json.load(json_file)
+    return base64.b64decode(data["instances"][0]["image"]["b64"])
+
+
+def sample_image_set(directory: str = None) -> Dict[str, bytes]:
+    """Return the images of a directory, or the example images shipped with
+    the docs: input.json and the cat and dog of the image pipeline example."""
+    if directory:
+        images = {}
+        for name in sorted(os.listdir(directory)):
+            with open(os.path.join(directory, name), "rb") as image_file:
+                images[name] = image_file.read()
+        return images
+    images = {"input.json": sample_image_bytes()}
+    for name in ["cat.json", "dog.json"]:
+        with open(os.path.join(IMAGE_PIPELINE_DIR, name)) as json_file:
+            images[name] = base64.b64decode(json.load(json_file)["instances"][0]["data"])
+    return images
+
+
+def synthetic_jpeg(width: int, height: int, quality: int = 90) -> bytes:
+    """Encode a smooth gradient image, which compresses like a natural photo."""
+    gradient = Image.linear_gradient("L").resize((width, height))
+    image = Image.merge(
+        "RGB",
+        (gradient, gradient.rotate(90), gradient.transpose(Image.FLIP_LEFT_RIGHT)),
+    )
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=quality)
+    return buffer.getvalue()
+
+
+def b64_payload(images: List[bytes]) -> Dict:
+    return {
+        "instances": [
+            {"image": {"b64": base64.b64encode(image).decode()}} for image in images
+        ]
+    }
+
+
+def timeit(fn: Callable[[], object], iterations: int, warmup: int = 1) -> List[float]:
+    """Run fn and return the wall time of each iteration in milliseconds."""
+    for _ in range(warmup):
+        fn()
+    timings = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        fn()
+        timings.append((time.perf_counter() - start) * 1000)
+    return timings
+
+
+def percentile(values: List[float], pct: float) -> float:
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def summarize(timings: List[float]) -> Dict[str, float]:
+    return {
+        "mean_ms": round(statistics.fmean(timings), 3),
+        "p50_ms": round(percentile(timings, 50), 3),
+        "p95_ms": round(percentile(timings, 95), 3),
+        "p99_ms": round(percentile(timings, 99), 3),
+    }
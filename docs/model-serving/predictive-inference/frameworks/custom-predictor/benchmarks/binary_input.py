@@ -0,0 +1,89 @@
+"""Compare sending images to the REST AlexNetModel as base64 encoded JSON,
+as a raw application/octet-stream body and as a multipart/form-data upload.
+
+    python binary_input.py --sizes 640x480 4032x3024 --images 1 8
+
+By default decoding and the forward pass are skipped, so that only the cost of
+transferring and unpacking the request is measured. Pass --end_to_end to
+include them.
+"""
+import argparse
+import asyncio
+import json
+
+import httpx
+import torch
+
+import bench_utils
+
+AlexNetModel = bench_utils.import_example("rest", "model").AlexNetModel
+
+URL = "http://localhost/v1/models/custom-model:predict"
+
+
+def json_request(images):
+    body = json.dumps(bench_utils.b64_payload(images)).encode()
+    return {"content": body, "headers": {"content-type": "application/json"}}
+
+
+def octet_stream_request(images):
+    return {"content": images[0], "headers": {"content-type": "application/octet-stream"}}
+
+
+def multipart_request(images):
+    files = [("image", (f"{i}.jpg", image, "image/jpeg")) for i, image in enumerate(images)]
+    request = httpx.Request("POST", URL, files=files)
+    return {"content": request.read(), "headers": {"content-type": request.headers["content-type"]}}
+
+
+async def run(args):
+    model = bench_utils.random_weights(AlexNetModel)("custom-model")
+    model.load()
+    if not args.end_to_end:
+        async def skip_inference(raw_images, timer=None):
+            return torch.zeros(len(raw_images), 1000)
+
+        model.pipeline._infer_images = skip_inference
+
+    transport = httpx.ASGITransport(app=bench_utils.rest_app(model))
+    async with httpx.AsyncClient(transport=transport) as client:
+        print(f"{'size':>10} {'images':>6} {'format':>13} {'body KB':>9} {'mean ms':>8} {'p99 ms':>8}")
+        for size in args.sizes:
+            width, height = (int(v) for v in size.split("x"))
+            image = bench_utils.synthetic_jpeg(width, height)
+            for n in args.images:
+                formats = {"json-b64": json_request, "multipart": multipart_request}
+                if n == 1:
+                    formats["octet-stream"] = octet_stream_request
+                for name, build in formats.items():
+                    request = build([image] * n)
+
+                    async def send():
+                        response = await client.post(URL, **request)
+                        response.raise_for_status()
+
+                    timings = []
+                    for i in range(args.iterations + 1):
+                        start = asyncio.get_running_loop().time()
+                        await send()
+                        # The first request warms up the app and is not counted.
+                        if i:
+                            timings.append((asyncio.get_running_loop().time() - start) * 1000)
+                    stats = bench_utils.summarize(timings)
+                    print(
+                        f"{size:>10} {n:>6} {name:>13} {len(request['content']) / 1024:>9.1f} "
+                        f"{stats['mean_ms']:>8.2f} {stats['p99_ms']:>8.2f}"
+                    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", nargs="+", default=["640x480", "1920x1080", "4032x3024"])
+    parser.add_argument("--images", type=int, nargs="+", default=[1, 8])
+    parser.add_argument("--iterations", type=int, default=20)
+    parser.add_argument("--end_to_end", action="store_true")
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
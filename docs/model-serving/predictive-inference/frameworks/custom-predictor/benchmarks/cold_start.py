@@ -0,0 +1,89 @@
+"""Measure the cold start of the example model servers, from starting the
+process until the first response to a liveness probe (time to first byte) and
+until the model reports ready. With the pretrained weights from the torch hub
+cache, with --model_path memory-mapping a local state_dict, and with both of
+them loaded in the background with --background_load.
+
+    python cold_start.py --variant rest --runs 5
+
+The weights are exported once to a temporary directory. With --random_weights
+randomly initialized weights are exported and also placed in a temporary torch
+hub cache, so nothing is downloaded and the download time is never measured.
+"""
+import argparse
+import os
+import statistics
+import tempfile
+import time
+from typing import Tuple
+
+import torch
+from torchvision import models
+
+import bench_utils
+
+
+def cold_start_seconds(variant: str, extra_args, env, timeout: float) -> Tuple[float, float]:
+    """Return the seconds from process start to the first liveness response
+    and to the model reporting ready."""
+    http_port = bench_utils.free_port()
+    start = time.monotonic()
+    process = bench_utils.start_server(variant, http_port, extra_args, env)
+    deadline = start + timeout
+    timings = []
+    try:
+        for path in ["/", "/v1/models/custom-model"]:
+            if not bench_utils.wait_ok(process, f"http://127.0.0.1:{http_port}{path}", deadline):
+                return float("nan"), float("nan")
+            timings.append(time.monotonic() - start)
+        return timings[0], timings[1]
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def export_weights(directory: str, random_weights: bool, env) -> str:
+    model = models.alexnet(pretrained=not random_weights)
+    path = os.path.join(directory, "alexnet.pt")
+    torch.save(model.state_dict(), path)
+    if random_weights:
+        # The pretrained weights are looked up in the torch hub cache first.
+        env["TORCH_HOME"] = os.path.join(directory, "torch")
+        url = models.AlexNet_Weights.IMAGENET1K_V1.url
+        checkpoints = os.path.join(env["TORCH_HOME"], "hub", "checkpoints")
+        os.makedirs(checkpoints)
+        torch.save(model.state_dict(), os.path.join(checkpoints, os.path.basename(url)))
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--variant", choices=list(bench_utils.SERVER_MODULES), default="rest")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--timeout", type=float, default=300)
+    parser.add_argument("--random_weights", action="store_true")
+    args = parser.parse_args()
+
+    env = dict(os.environ)
+    with tempfile.TemporaryDirectory() as directory:
+        model_path = export_weights(directory, args.random_weights, env)
+        cases = {
+            "pretrained": [],
+            "model_path": ["--model_path", model_path],
+            "pretrained background": ["--background_load"],
+            "model_path background": ["--model_path", model_path, "--background_load"],
+        }
+        print(f"{'case':>22} {'first byte s':>13} {'ready s':>8} {'max ready s':>12}")
+        for name, extra_args in cases.items():
+            first_byte, ready = zip(*[
+                cold_start_seconds(args.variant, extra_args, env, args.timeout)
+                for _ in range(args.runs)
+            ])
+            print(
+                f"{name:>22} {statistics.fmean(first_byte):>13.2f} "
+                f"{statistics.fmean(ready):>8.2f} {max(ready):>12.2f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+"""Measure when gRPC compression pays off for batched image requests on
+bandwidth-limited links.
+
+Requests are sent with the channel options of grpc_client.py through a local
+proxy that forwards at --mbits megabits per second in each direction, to a
+stand-in server that answers right away, so that only the transfer and the
+compression are timed. Two payloads are compared: a BYTES batch of encoded
+JPEG images, which hardly compress, and an FP32 batch of the same images
+preprocessed to [N, 3, 224, 224], which are sent as raw_input_contents.
+
+    python compression.py --batch_size 8 --mbits 10 100 1000
+
+Reports the bytes sent per request and the median latency for every payload,
+bandwidth and compression.
+"""
+import argparse
+import asyncio
+import statistics
+import time
+from typing import Dict, List
+
+import torch
+from kserve import InferInput, InferRequest
+from kserve.inference_client import InferenceGRPCClient
+
+import bench_utils
+from hedging import StandInServer
+
+grpc_client = bench_utils.import_example("grpc", "grpc_client")
+serving_utils = bench_utils.import_example("grpc", "serving_utils")
+
+
+class ThrottledProxy:
+    """Forwards TCP connections to a local port at a limited bandwidth in each
+    direction, like a slow link, and counts the bytes sent upstream."""
+
+    def __init__(self, target_port: int):
+        self.target_port = target_port
+        self.bytes_per_second = 0.0
+        self.sent = 0
+
+    async def pipe(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, upstream: bool):
+        next_free = time.perf_counter()
+        try:
+            while chunk := await reader.read(16384):
+                if upstream:
+                    self.sent += len(chunk)
+                # Every chunk leaves once the link finished sending the previous ones.
+                next_free = max(next_free, time.perf_counter()) + len(chunk) / self.bytes_per_second
+                await asyncio.sleep(next_free - time.perf_counter())
+                writer.write(chunk)
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        target_reader, target_writer = await asyncio.open_connection("127.0.0.1", self.target_port)
+        await asyncio.gather(
+            self.pipe(reader, target_writer, True), self.pipe(target_reader, writer, False)
+        )
+
+    async def serve(self, port: int) -> asyncio.AbstractServer:
+        return await asyncio.start_server(self.handle, "127.0.0.1", port)
+
+
+def make_payloads(batch_size: int) -> Dict[str, InferRequest]:
+    images = list(bench_utils.sample_image_set().values())
+    batch = [images[i % len(images)] for i in range(batch_size)]
+    jpeg = InferInput(name="input-0", shape=[batch_size], datatype="BYTES", data=batch)
+    preprocessor = serving_utils.ImagePreprocessor()
+    tensor = torch.stack([preprocessor(image) for image in batch])
+    fp32 = InferInput(name="input-0", shape=list(tensor.shape), datatype="FP32")
+    fp32.set_data_from_numpy(tensor.numpy(), binary_data=True)
+    return {
+        name: InferRequest(infer_inputs=[infer_input], model_name="custom-model")
+        for name, infer_input in [("jpeg", jpeg), ("fp32", fp32)]
+    }
+
+
+async def measure(url: str, proxy: ThrottledProxy, request: InferRequest, compression: str,
+                  requests: int) -> Dict[str, float]:
+    client = InferenceGRPCClient(url=url, channel_args=grpc_client.channel_options(compression))
+    try:
+        # Connects and warms up the channel before measuring.
+        await client.infer(infer_request=request, timeout=600)
+        proxy.sent = 0
+        latencies: List[float] = []
+        for _ in range(requests):
+            start = time.perf_counter()
+            await client.infer(infer_request=request, timeout=600)
+            latencies.append((time.perf_counter() - start) * 1000)
+    finally:
+        await client.close()
+    return {"sent_kb": proxy.sent / requests / 1024, "median_ms": statistics.median(latencies)}
+
+
+async def run(args):
+    stand_in = StandInServer(service_ms=0, slow_ms=0, slow_fraction=0)
+    server_port = bench_utils.free_port()
+    server = await stand_in.serve(server_port, [("grpc.max_receive_message_length", -1)])
+    proxy = ThrottledProxy(server_port)
+    proxy_port = bench_utils.free_port()
+    proxy_server = await proxy.serve(proxy_port)
+    url = f"127.0.0.1:{proxy_port}"
+    payloads = make_payloads(args.batch_size)
+    print(f"{'payload':>8} {'Mbit/s':>7} {'compression':>11} {'KB sent':>9} {'median ms':>10} {'vs ' + args.compression[0]:>8}")
+    try:
+        for name, request in payloads.items():
+            for mbits in args.mbits:
+                proxy.bytes_per_second = mbits * 1e6 / 8
+                baseline = None
+                for compression in args.compression:
+                    result = await measure(url, proxy, request, compression, args.requests)
+                    baseline = baseline or result["median_ms"]
+                    print(
+                        f"{name:>8} {mbits:>7g} {compression:>11} {result['sent_kb']:>9.0f} "
+                        f"{result['median_ms']:>10.1f} {result['median_ms'] / baseline:>7.2f}x"
+                    )
+    finally:
+        proxy_server.close()
+        await server.stop(None)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--batch_size", type=int, default=8)
+    parser.add_argument("--mbits", type=float, nargs="+", default=[10, 100, 1000],
+                        help="The link bandwidths in megabits per second.")
+    parser.add_argument("--compression", nargs="+", default=["none", "gzip", "deflate"],
+                        choices=list(grpc_client.COMPRESSION),
+                        help="The compressions to compare, relative to the first one.")
+    parser.add_argument("--requests", type=int, default=5,
+                        help="The requests per payload, bandwidth and compression.")
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""Measure decode + preprocess latency and peak memory of the image decoders
+on a synthetic corpus of JPEG images of different sizes.
+
+    python decoding.py --sizes 640x480 1920x1080 4032x3024 --iterations 20
+
+Peak memory is the growth of the resident set while preprocessing one
+image in a fresh interpreter, it is only available on Linux.
+"""
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+
+import bench_utils
+
+serving_utils = bench_utils.import_example("rest", "serving_utils")
+
+
+def read_status_kb(field: str) -> int:
+    with open("/proc/self/status") as status:
+        for line in status:
+            if line.startswith(field + ":"):
+                return int(line.split()[1])
+    raise KeyError(field)
+
+
+def measure_peak_memory(decoder: str, path: str):
+    """Print how much the resident set grows at most while preprocessing the
+    image at path. Runs in a fresh interpreter, freed memory of earlier
+    measurements would otherwise be reused and hide the peak."""
+    with open(path, "rb") as image_file:
+        image = image_file.read()
+    preprocessor = serving_utils.ImagePreprocessor(decoder=decoder)
+    # Writing 5 to clear_refs resets the high water mark to the current RSS.
+    with open("/proc/self/clear_refs", "w") as clear_refs:
+        clear_refs.write("5")
+    before = read_status_kb("VmRSS")
+    preprocessor(image)
+    print((read_status_kb("VmHWM") - before) / 1024)
+
+
+def peak_memory_mb(decoder: str, path: str) -> float:
+    result = subprocess.run(
+        [sys.executable, __file__, "--measure", decoder, path],
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode != 0:
+        return float("nan")
+    return float(result.stdout.strip().splitlines()[-1])
+
+
+def run_size(size: str, corpus: str, iterations: int):
+    width, height = (int(v) for v in size.split("x"))
+    image = bench_utils.synthetic_jpeg(width, height)
+    path = os.path.join(corpus, f"{size}.jpg")
+    with open(path, "wb") as image_file:
+        image_file.write(image)
+    for decoder in serving_utils.IMAGE_DECODERS:
+        preprocessor = serving_utils.ImagePreprocessor(decoder=decoder)
+        stats = bench_utils.summarize(
+            bench_utils.timeit(lambda: preprocessor(image), iterations)
+        )
+        peak = peak_memory_mb(decoder, path)
+        print(
+            f"{size:>10} {decoder:>12} {stats['mean_ms']:>8.2f} "
+            f"{stats['p99_ms']:>8.2f} {peak:>8.1f}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--sizes", nargs="+", default=["640x480", "1920x1080", "4032x3024", "6000x4000"]
+    )
+    parser.add_argument("--iterations", type=int, default=20)
+    parser.add_argument("--measure", nargs=2, metavar=("DECODER", "PATH"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.measure:
+        measure_peak_memory(*args.measure)
+        return
+
+    print(f"{'size':>10} {'decoder':>12} {'mean ms':>8} {'p99 ms':>8} {'peak MB':>8}")
+    with tempfile.TemporaryDirectory() as corpus:
+        for size in args.sizes:
+            run_size(size, corpus, args.iterations)
+
+
+if __name__ == "__main__":
+    main()
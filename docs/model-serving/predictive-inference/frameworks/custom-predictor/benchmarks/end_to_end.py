@@ -0,0 +1,283 @@
+"""Benchmark the REST, gRPC and Ray model servers end to end: each server is
+started on localhost with randomly initialized weights and driven by a closed
+loop of concurrent clients sending single images of a synthetic JPEG corpus.
+
+    python end_to_end.py --variants rest grpc ray --concurrency 1 4 16 --output results.json
+    python end_to_end.py --baseline results.json --threshold 0.15
+
+Reports the p50/p95/p99 latency, the requests per second, the CPU time used
+by the server and all processes it started, as a share of one CPU, and their
+peak RSS. Results are saved as JSON with --output. With --baseline the run
+fails when the p99 latency grew or the throughput dropped by more than
+--threshold against a stored result. Process metrics are only available on
+Linux.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+from typing import Dict, List
+
+import httpx
+import torch
+from kserve import InferInput, InferRequest
+from kserve.inference_client import InferenceGRPCClient
+from torchvision import models
+
+import bench_utils
+
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+# The reported metrics and their column titles.
+REPORT_COLUMNS = {
+    "p50_ms": "p50 ms",
+    "p95_ms": "p95 ms",
+    "p99_ms": "p99 ms",
+    "requests_per_second": "req/s",
+    "errors": "errors",
+    "server_cpu": "cpu",
+    "server_peak_rss_mb": "rss MB",
+}
+
+
+def cpu_seconds(pid: int) -> float:
+    with open(f"/proc/{pid}/stat") as stat:
+        # The fields after the command name, utime and stime are fields 14 and 15.
+        fields = stat.read().rpartition(")")[2].split()
+    return (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+
+
+def rss_mb(pid: int) -> float:
+    with open(f"/proc/{pid}/status") as status:
+        for line in status:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+class ProcessSampler:
+    """Samples the CPU time and the RSS of a process tree while a load runs."""
+
+    def __init__(self, pid: int, interval: float = 0.2):
+        self.pid = pid
+        self.interval = interval
+        self.cpu: Dict[int, float] = {}
+        self.start_cpu: Dict[int, float] = {}
+        self.peak_rss_mb = 0.0
+
+    def sample(self):
+        rss = 0.0
+        for pid in bench_utils.process_tree(self.pid):
+            try:
+                self.cpu[pid] = cpu_seconds(pid)
+                rss += rss_mb(pid)
+            except OSError:
+                continue
+        self.peak_rss_mb = max(self.peak_rss_mb, rss)
+
+    async def run(self):
+        self.sample()
+        self.start_cpu = dict(self.cpu)
+        while True:
+            await asyncio.sleep(self.interval)
+            self.sample()
+
+    def cpu_used(self) -> float:
+        # Processes started during the load count from zero, the CPU time of
+        # processes that exited since their last sample is lost.
+        return sum(cpu - self.start_cpu.get(pid, 0.0) for pid, cpu in self.cpu.items())
+
+
+class RestClient:
+    def __init__(self, http_port: int):
+        self.url = f"http://127.0.0.1:{http_port}/v1/models/custom-model:predict"
+        self.client = httpx.AsyncClient(timeout=60, limits=httpx.Limits(max_connections=None))
+
+    def payload(self, image: bytes):
+        return json.dumps(bench_utils.b64_payload([image])).encode()
+
+    async def send(self, payload):
+        response = await self.client.post(
+            self.url, content=payload, headers={"content-type": "application/json"}
+        )
+        response.raise_for_status()
+
+    async def close(self):
+        await self.client.aclose()
+
+
+class GrpcClient:
+    def __init__(self, grpc_port: int):
+        self.client = InferenceGRPCClient(url=f"127.0.0.1:{grpc_port}", timeout=60)
+
+    def payload(self, image: bytes):
+        return image
+
+    async def send(self, payload):
+        infer_input = InferInput(name="input-0", shape=[1], datatype="BYTES", data=[payload])
+        await self.client.infer(
+            InferRequest(infer_inputs=[infer_input], model_name="custom-model")
+        )
+
+    async def close(self):
+        await self.client.close()
+
+
+async def closed_loop(client, payloads: List, concurrency: int, requests: int) -> Dict:
+    """Send requests from concurrency clients, each sending its next request
+    as soon as the previous one completed."""
+    latencies = []
+    errors = 0
+    sent = 0
+
+    async def worker():
+        nonlocal errors, sent
+        while sent < requests:
+            payload = payloads[sent % len(payloads)]
+            sent += 1
+            start = time.perf_counter()
+            try:
+                await client.send(payload)
+            except Exception:
+                errors += 1
+                continue
+            latencies.append((time.perf_counter() - start) * 1000)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    wall = time.perf_counter() - start
+    return {"latencies": latencies, "errors": errors, "seconds": wall}
+
+
+async def run_variant(variant: str, model_path: str, images: List[bytes], args) -> Dict:
+    http_port, grpc_port = bench_utils.free_port(), bench_utils.free_port()
+    process = bench_utils.start_server(
+        variant, http_port, ["--model_path", model_path] + args.server_args,
+        grpc_port=grpc_port,
+    )
+    try:
+        ready = f"http://127.0.0.1:{http_port}/v1/models/custom-model"
+        if not bench_utils.wait_ok(process, ready, time.monotonic() + args.timeout):
+            raise RuntimeError(f"The {variant} model server did not get ready")
+        client = GrpcClient(grpc_port) if variant == "grpc" else RestClient(http_port)
+        payloads = [client.payload(image) for image in images]
+        results = {}
+        try:
+            await closed_loop(client, payloads, 1, args.warmup)
+            for concurrency in args.concurrency:
+                sampler = ProcessSampler(process.pid)
+                sampling = asyncio.create_task(sampler.run())
+                load = await closed_loop(client, payloads, concurrency, args.requests)
+                sampling.cancel()
+                sampler.sample()
+                if not load["latencies"]:
+                    raise RuntimeError(f"All requests to the {variant} model server failed")
+                results[str(concurrency)] = {
+                    **bench_utils.summarize(load["latencies"]),
+                    "requests_per_second": round(len(load["latencies"]) / load["seconds"], 2),
+                    "errors": load["errors"],
+                    "server_cpu": round(sampler.cpu_used() / load["seconds"], 2),
+                    "server_peak_rss_mb": round(sampler.peak_rss_mb, 1),
+                }
+                print(f"{variant:>5} {concurrency:>11} " + " ".join(
+                    f"{results[str(concurrency)][key]:>9}" for key in REPORT_COLUMNS
+                ))
+        finally:
+            await client.close()
+        return results
+    finally:
+        process.terminate()
+        try:
+            process.wait(timeout=30)
+        except Exception:
+            process.kill()
+            process.wait()
+
+
+def regressions(results: Dict, baseline: Dict, threshold: float) -> List[str]:
+    """Compare the results of every variant and concurrency the baseline has."""
+    found = []
+    for variant, levels in results["results"].items():
+        for concurrency, stats in levels.items():
+            base = baseline["results"].get(variant, {}).get(concurrency)
+            if base is None:
+                continue
+            name = f"{variant} at concurrency {concurrency}"
+            if stats["p99_ms"] > base["p99_ms"] * (1 + threshold):
+                found.append(f"{name}: p99 {base['p99_ms']} -> {stats['p99_ms']} ms")
+            if stats["requests_per_second"] < base["requests_per_second"] * (1 - threshold):
+                found.append(
+                    f"{name}: {base['requests_per_second']} -> "
+                    f"{stats['requests_per_second']} requests/s"
+                )
+    return found
+
+
+async def run(args) -> Dict:
+    images = [
+        bench_utils.synthetic_jpeg(*(int(v) for v in size.split("x")), quality=90 - i)
+        for i, size in enumerate(args.sizes)
+    ]
+    results = {
+        "environment": {
+            "python": platform.python_version(),
+            "torch": torch.__version__,
+            "cpus": os.cpu_count(),
+            "machine": platform.machine(),
+        },
+        "arguments": {
+            "concurrency": args.concurrency,
+            "requests": args.requests,
+            "sizes": args.sizes,
+            "server_args": args.server_args,
+        },
+        "results": {},
+    }
+    print(f"{'':>5} {'concurrency':>11} " + " ".join(f"{title:>9}" for title in REPORT_COLUMNS.values()))
+    with tempfile.TemporaryDirectory() as directory:
+        model_path = os.path.join(directory, "alexnet.pt")
+        torch.save(models.alexnet().state_dict(), model_path)
+        for variant in args.variants:
+            results["results"][variant] = await run_variant(variant, model_path, images, args)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--variants", nargs="+", default=["rest", "grpc", "ray"],
+                        choices=sorted(bench_utils.SERVER_MODULES))
+    parser.add_argument("--concurrency", nargs="+", type=int, default=[1, 4, 16])
+    parser.add_argument("--requests", type=int, default=200,
+                        help="The number of requests at every concurrency.")
+    parser.add_argument("--warmup", type=int, default=10)
+    parser.add_argument("--sizes", nargs="+", default=["640x480", "1024x768", "1920x1080"],
+                        help="The sizes of the synthetic JPEG images, cycled through.")
+    parser.add_argument("--timeout", type=float, default=300)
+    parser.add_argument("--output", help="Save the results as JSON to this file.")
+    parser.add_argument("--baseline", help="Fail when the results regressed against this file.")
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="The tolerated relative regression against --baseline.")
+    parser.add_argument(
+        "--server_args", nargs=argparse.REMAINDER, default=[],
+        help="Further arguments of the model servers, must come last.",
+    )
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(results, output, indent=2)
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            found = regressions(results, json.load(baseline_file), args.threshold)
+        for regression in found:
+            print(f"regression: {regression}")
+        if found:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
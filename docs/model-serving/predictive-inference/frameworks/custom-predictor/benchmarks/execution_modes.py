@@ -0,0 +1,82 @@
+"""Compare the --execution_mode options of the REST AlexNetModel: the time
+load() takes, the latency of the first forward pass without warm-up and the
+steady state latency, with an empty compile cache and once it is populated.
+
+    python execution_modes.py --modes eager script compile --batch_sizes 1 8
+
+Each measurement runs in a fresh interpreter, so that nothing compiled by an
+earlier one is reused from memory.
+"""
+import argparse
+import json
+import subprocess
+import sys
+import tempfile
+import time
+
+import torch
+
+import bench_utils
+
+AlexNetModel = bench_utils.import_example("rest", "model").AlexNetModel
+
+
+def measure(mode: str, cache_dir: str, batch_sizes, iterations: int):
+    """Print the load time, first forward latency and steady state latency of
+    each batch size as JSON."""
+    model = bench_utils.random_weights(AlexNetModel)(
+        "custom-model",
+        execution_mode=mode,
+        compile_cache_dir=cache_dir,
+        warm_up_batch_sizes=[],
+    )
+    start = time.perf_counter()
+    model.load()
+    result = {"load_s": time.perf_counter() - start, "first_ms": {}, "steady_ms": {}}
+    for batch_size in batch_sizes:
+        batch = torch.randn(batch_size, 3, 224, 224)
+        start = time.perf_counter()
+        model.pipeline.forward(batch)
+        result["first_ms"][batch_size] = (time.perf_counter() - start) * 1000
+        timings = bench_utils.timeit(lambda: model.pipeline.forward(batch), iterations)
+        result["steady_ms"][batch_size] = bench_utils.summarize(timings)["mean_ms"]
+    print(json.dumps(result))
+
+
+def run(mode: str, cache_dir: str, batch_sizes, iterations: int):
+    result = subprocess.run(
+        [sys.executable, __file__, "--measure", mode, cache_dir,
+         "--batch_sizes", *map(str, batch_sizes), "--iterations", str(iterations)],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--modes", nargs="+", default=["eager", "script", "compile"])
+    parser.add_argument("--batch_sizes", type=int, nargs="+", default=[1, 8])
+    parser.add_argument("--iterations", type=int, default=20)
+    parser.add_argument("--measure", nargs=2, metavar=("MODE", "CACHE_DIR"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.measure:
+        measure(*args.measure, args.batch_sizes, args.iterations)
+        return
+
+    print(f"{'mode':>8} {'cache':>6} {'batch':>5} {'load s':>7} {'first ms':>9} {'steady ms':>10}")
+    for mode in args.modes:
+        with tempfile.TemporaryDirectory() as cache_dir:
+            for cache in ["empty", "warm"]:
+                result = run(mode, cache_dir, args.batch_sizes, args.iterations)
+                for batch_size in args.batch_sizes:
+                    print(
+                        f"{mode:>8} {cache:>6} {batch_size:>5} {result['load_s']:>7.2f} "
+                        f"{result['first_ms'][str(batch_size)]:>9.1f} "
+                        f"{result['steady_ms'][str(batch_size)]:>10.2f}"
+                    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,167 @@
+"""Measure the tail latency saved by the hedged requests of grpc_client.py.
+
+A local stand-in server answers ModelInfer calls like the gRPC custom
+predictor after --service_ms, and a --slow_fraction of them only after an
+extra --slow_ms, like a replica in a garbage collection pause or on a busy
+node. The same closed-loop load is run without and with hedging, and the
+latency percentiles, the hedges that fired and the extra calls they cost are
+reported side by side.
+
+    python hedging.py --hedge_percentile 95 --slow_fraction 0.03 --slow_ms 300
+"""
+import argparse
+import asyncio
+import logging
+import random
+from typing import Any, Dict, Optional, Sequence, Tuple
+
+import grpc
+from kserve.inference_client import InferenceGRPCClient
+from kserve.protocol.grpc.grpc_predict_v2_pb2 import (
+    InferTensorContents,
+    ModelInferRequest,
+    ModelInferResponse,
+)
+
+import bench_utils
+
+PERCENTILES = [50, 90, 99, 99.9, 100]
+
+
+class StandInServer:
+    """Answers ModelInfer calls after service_ms, a slow_fraction of them after
+    an extra slow_ms, and counts the calls its clients cancelled."""
+
+    def __init__(self, service_ms: float, slow_ms: float, slow_fraction: float, seed: int = 0):
+        self.service_ms = service_ms
+        self.slow_ms = slow_ms
+        self.slow_fraction = slow_fraction
+        self.rng = random.Random(seed)
+        self.calls = 0
+        self.cancelled = 0
+
+    async def model_infer(self, request: ModelInferRequest, context) -> ModelInferResponse:
+        self.calls += 1
+        milliseconds = self.service_ms
+        if self.rng.random() < self.slow_fraction:
+            milliseconds += self.slow_ms
+        try:
+            await asyncio.sleep(milliseconds / 1000)
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+        output = ModelInferResponse.InferOutputTensor(
+            name="output-0",
+            datatype="FP32",
+            shape=[1, 5],
+            contents=InferTensorContents(fp32_contents=[0.2] * 5),
+        )
+        return ModelInferResponse(model_name=request.model_name, id=request.id, outputs=[output])
+
+    async def serve(self, port: int, options: Sequence[Tuple[str, Any]] = ()) -> grpc.aio.Server:
+        server = grpc.aio.server(options=options)
+        handler = grpc.unary_unary_rpc_method_handler(
+            self.model_infer,
+            request_deserializer=ModelInferRequest.FromString,
+            response_serializer=ModelInferResponse.SerializeToString,
+        )
+        server.add_generic_rpc_handlers((
+            grpc.method_handlers_generic_handler(
+                "inference.GRPCInferenceService", {"ModelInfer": handler}
+            ),
+        ))
+        server.add_insecure_port(f"127.0.0.1:{port}")
+        await server.start()
+        return server
+
+
+async def measure(args, grpc_client, stand_in: StandInServer, url: str,
+                  hedge_percentile: Optional[float]) -> Dict:
+    """Run the load of grpc_client.py against the stand-in server and return
+    its latencies and counters."""
+    stand_in.calls = stand_in.cancelled = 0
+    stand_in.rng.seed(args.seed)
+    clients = [
+        InferenceGRPCClient(url=url, channel_args=[("grpc.use_local_subchannel_pool", 1)])
+        for _ in range(args.channels)
+    ]
+    requests = grpc_client.make_requests([bench_utils.sample_image_bytes()], 1, "custom-model")
+    hedger = None if hedge_percentile is None else grpc_client.Hedger(hedge_percentile)
+    try:
+        latencies, seconds, errors = await grpc_client.run_load(
+            clients, requests, args.requests, args.in_flight, args.deadline_ms / 1000, hedger
+        )
+    finally:
+        for client in clients:
+            await client.close()
+    return {
+        "latencies": latencies,
+        "errors": errors,
+        "requests_per_second": len(latencies) / seconds,
+        "calls": stand_in.calls,
+        "cancelled": stand_in.cancelled,
+        "hedger": hedger,
+    }
+
+
+def report(name: str, result: Dict):
+    values = " ".join(
+        f"{bench_utils.percentile(result['latencies'], pct):>8.1f}" for pct in PERCENTILES
+    )
+    print(
+        f"{name:>10} {values} {result['requests_per_second']:>7.1f} {result['errors']:>6} "
+        f"{result['calls']:>6} {result['cancelled']:>9}"
+    )
+
+
+async def run(args):
+    # Calls past their deadline are counted as errors, the client logs each of them.
+    logging.getLogger("kserve").setLevel(logging.CRITICAL)
+    grpc_client = bench_utils.import_example("grpc", "grpc_client")
+    stand_in = StandInServer(args.service_ms, args.slow_ms, args.slow_fraction, args.seed)
+    port = bench_utils.free_port()
+    server = await stand_in.serve(port)
+    url = f"127.0.0.1:{port}"
+    try:
+        baseline = await measure(args, grpc_client, stand_in, url, None)
+        hedged = await measure(args, grpc_client, stand_in, url, args.hedge_percentile)
+    finally:
+        await server.stop(None)
+
+    print(f"{'ms':>10} " + " ".join(
+        f"{'max' if pct == 100 else f'p{pct}':>8}" for pct in PERCENTILES
+    ) + f" {'req/s':>7} {'errors':>6} {'calls':>6} {'cancelled':>9}")
+    report("baseline", baseline)
+    report(f"hedge p{args.hedge_percentile:g}", hedged)
+    print(hedged["hedger"].summary())
+    for pct in [99, 99.9]:
+        saved = (bench_utils.percentile(baseline["latencies"], pct)
+                 - bench_utils.percentile(hedged["latencies"], pct))
+        print(f"p{pct} saved: {saved:.1f} ms")
+    print(f"extra calls: {100 * (hedged['calls'] / max(1, baseline['calls']) - 1):.1f}%")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--channels", type=int, default=2,
+                        help="The gRPC channels, duplicates are sent on the next channel.")
+    parser.add_argument("--in_flight", type=int, default=4,
+                        help="The requests kept in flight on every channel.")
+    parser.add_argument("--deadline_ms", type=float, default=1000)
+    parser.add_argument("--hedge_percentile", type=float, default=95)
+    parser.add_argument("--service_ms", type=float, default=10,
+                        help="The latency of the stand-in server.")
+    parser.add_argument("--slow_ms", type=float, default=300,
+                        help="The extra latency of the slow calls.")
+    parser.add_argument("--slow_fraction", type=float, default=0.03,
+                        help="The share of slow calls.")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,48 @@
+"""Compare the per-image cost of one multi-instance request against sending
+the same images as single-instance requests to the REST AlexNetModel.
+
+    python multi_instance.py --instances 1 8 16 32 64
+"""
+import argparse
+import asyncio
+
+import bench_utils
+
+AlexNetModel = bench_utils.import_example("rest", "model").AlexNetModel
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--instances", type=int, nargs="+", default=[1, 8, 16, 32, 64])
+    parser.add_argument("--iterations", type=int, default=5)
+    args = parser.parse_args()
+
+    model = bench_utils.random_weights(AlexNetModel)("custom-model")
+    model.load()
+    image = bench_utils.sample_image_bytes()
+    loop = asyncio.new_event_loop()
+
+    print(f"{'instances':>9} {'single ms/img':>14} {'batched ms/img':>15} {'speedup':>8}")
+    for n in args.instances:
+        single = bench_utils.b64_payload([image])
+        batched = bench_utils.b64_payload([image] * n)
+
+        def run_single():
+            for _ in range(n):
+                loop.run_until_complete(model.predict(single))
+
+        def run_batched():
+            loop.run_until_complete(model.predict(batched))
+
+        single_ms = bench_utils.summarize(bench_utils.timeit(run_single, args.iterations))
+        batched_ms = bench_utils.summarize(bench_utils.timeit(run_batched, args.iterations))
+        per_single = single_ms["mean_ms"] / n
+        per_batched = batched_ms["mean_ms"] / n
+        print(
+            f"{n:>9} {per_single:>14.2f} {per_batched:>15.2f} "
+            f"{per_single / per_batched:>7.2f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,232 @@
+"""Open-loop load generator for the REST custom predictor and the image
+pipeline InferenceGraph.
+
+Requests are scheduled at a fixed arrival rate, with constant or Poisson
+(exponentially distributed) gaps, and sent over a pool of keep-alive
+connections, one request at a time per connection. When the server stalls
+and every connection is busy, the next requests are sent late. A closed-loop
+client would then simply measure from the late send and hide the stall,
+known as coordinated omission. This generator also measures every request from
+the time it was scheduled, and reports both.
+
+    python open_loop.py --url http://localhost:8080/v1/models/custom-model:predict --rate 20 --duration 30
+    python open_loop.py --url http://${INGRESS_HOST}:${INGRESS_PORT} --host ${SERVICE_HOSTNAME} --payload graph
+
+--payload model sends the cat and dog images of the image pipeline example in
+the input format of the custom predictor, --payload graph sends cat.json and
+dog.json as they are to an InferenceGraph. Without --url a local stand-in
+server is started, which answers like the custom predictor after --service_ms
+on a single worker and stalls for --stall_ms every --stall_every seconds.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import time
+from typing import Dict, List
+
+import httpx
+
+import bench_utils
+
+PERCENTILES = [50, 90, 99, 99.9, 100]
+
+
+def schedule(rate: float, duration: float, distribution: str, seed: int = 0) -> List[float]:
+    """Return the send times of the requests in seconds from the start."""
+    rng = random.Random(seed)
+    offsets = []
+    offset = 0.0
+    while True:
+        offset += rng.expovariate(rate) if distribution == "poisson" else 1 / rate
+        if offset >= duration:
+            return offsets
+        offsets.append(offset)
+
+
+def load_payloads(kind: str) -> List[bytes]:
+    """Return the cat.json and dog.json request bodies of the image pipeline,
+    as they are or in the input format of the custom predictor."""
+    payloads = []
+    for name in ["cat.json", "dog.json"]:
+        with open(os.path.join(bench_utils.IMAGE_PIPELINE_DIR, name)) as json_file:
+            payload = json.load(json_file)
+        if kind == "model":
+            payload = {
+                "instances": [
+                    {"image": {"b64": instance["data"]}} for instance in payload["instances"]
+                ]
+            }
+        payloads.append(json.dumps(payload).encode())
+    return payloads
+
+
+async def open_loop(
+    url: str,
+    payloads: List[bytes],
+    offsets: List[float],
+    connections: int,
+    headers: Dict[str, str],
+    timeout: float,
+) -> Dict:
+    """Send a request at every offset over a pool of keep-alive connections and
+    return the latencies in milliseconds, measured from the scheduled and from
+    the actual send time."""
+    corrected: List[float] = []
+    uncorrected: List[float] = []
+    errors = 0
+    next_request = 0
+
+    async def connection(client: httpx.AsyncClient):
+        nonlocal errors, next_request
+        while next_request < len(offsets):
+            i = next_request
+            next_request += 1
+            scheduled = start + offsets[i]
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            sent = time.perf_counter()
+            try:
+                response = await client.post(
+                    url, content=payloads[i % len(payloads)], headers=headers
+                )
+                response.raise_for_status()
+            except httpx.HTTPError:
+                errors += 1
+                continue
+            done = time.perf_counter()
+            corrected.append((done - scheduled) * 1000)
+            uncorrected.append((done - sent) * 1000)
+
+    # Every client holds a single keep-alive connection. They are created
+    # before the clock starts, creating their SSL contexts takes a while.
+    limits = httpx.Limits(max_connections=1, max_keepalive_connections=1)
+    clients = [httpx.AsyncClient(limits=limits, timeout=timeout) for _ in range(connections)]
+    start = time.perf_counter()
+    try:
+        await asyncio.gather(*[connection(client) for client in clients])
+    finally:
+        for client in clients:
+            await client.aclose()
+    return {
+        "corrected": corrected,
+        "uncorrected": uncorrected,
+        "errors": errors,
+        "seconds": time.perf_counter() - start,
+    }
+
+
+class StandInServer:
+    """Answers predict requests like the custom predictor, after service_ms on
+    a single worker, and stalls for stall_ms every stall_every seconds, e.g. as
+    a garbage collection or a slow batch would."""
+
+    def __init__(self, service_ms: float, stall_ms: float, stall_every: float):
+        self.service_ms = service_ms
+        self.stall_ms = stall_ms
+        self.stall_every = stall_every
+        self.worker = asyncio.Lock()
+        self.next_stall = time.monotonic() + stall_every
+
+    def app(self):
+        from fastapi import FastAPI, Request
+
+        app = FastAPI()
+
+        @app.post("/")
+        @app.post("/v1/models/{model_name}:predict")
+        async def predict(request: Request):
+            instances = (await request.json())["instances"]
+            async with self.worker:
+                seconds = self.service_ms / 1000
+                if self.stall_every and time.monotonic() >= self.next_stall:
+                    self.next_stall = time.monotonic() + self.stall_every
+                    seconds += self.stall_ms / 1000
+                await asyncio.sleep(seconds)
+            return {"predictions": [[0.2] * 5 for _ in instances]}
+
+        return app
+
+    async def serve(self, port: int):
+        import uvicorn
+
+        config = uvicorn.Config(self.app(), host="127.0.0.1", port=port, log_level="warning")
+        server = uvicorn.Server(config)
+        task = asyncio.create_task(server.serve())
+        while not server.started:
+            await asyncio.sleep(0.01)
+        return server, task
+
+
+def report(name: str, latencies: List[float]):
+    values = " ".join(
+        f"{bench_utils.percentile(latencies, pct):>9.1f}" for pct in PERCENTILES
+    )
+    print(f"{name:>12} {values}")
+
+
+async def run(args):
+    offsets = schedule(args.rate, args.duration, args.distribution, args.seed)
+    payloads = load_payloads(args.payload)
+    headers = {"content-type": "application/json"}
+    if args.host:
+        headers["host"] = args.host
+    url = args.url
+    stand_in = None
+    if url is None:
+        port = bench_utils.free_port()
+        stand_in = await StandInServer(args.service_ms, args.stall_ms, args.stall_every).serve(port)
+        url = f"http://127.0.0.1:{port}/v1/models/custom-model:predict"
+    try:
+        result = await open_loop(url, payloads, offsets, args.connections, headers, args.timeout)
+    finally:
+        if stand_in is not None:
+            server, task = stand_in
+            server.should_exit = True
+            await task
+
+    completed = len(result["corrected"])
+    print(
+        f"{completed} of {len(offsets)} requests completed, {result['errors']} errors, "
+        f"{len(offsets) / args.duration:.1f} requests/s scheduled, "
+        f"{completed / result['seconds']:.1f} requests/s completed"
+    )
+    if not completed:
+        return
+    print(f"{'ms':>12} " + " ".join(
+        f"{'max' if pct == 100 else f'p{pct}':>9}" for pct in PERCENTILES
+    ))
+    report("corrected", result["corrected"])
+    report("uncorrected", result["uncorrected"])
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--url", default=None,
+                        help="The predict URL, a local stand-in server is used when unset.")
+    parser.add_argument("--host", default=None,
+                        help="The Host header, e.g. the hostname of the InferenceService.")
+    parser.add_argument("--payload", default="model", choices=["model", "graph"])
+    parser.add_argument("--rate", type=float, default=20, help="Requests per second.")
+    parser.add_argument("--duration", type=float, default=30, help="Seconds of load.")
+    parser.add_argument("--distribution", default="poisson", choices=["poisson", "constant"])
+    parser.add_argument("--connections", type=int, default=16,
+                        help="The number of keep-alive connections.")
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--service_ms", type=float, default=20,
+                        help="The latency of the stand-in server.")
+    parser.add_argument("--stall_ms", type=float, default=1000,
+                        help="How long the stand-in server stalls.")
+    parser.add_argument("--stall_every", type=float, default=10,
+                        help="How often in seconds the stand-in server stalls, 0 never.")
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+"""Compare the prebuilt ImagePreprocessor against building the torchvision
+pipeline on every request, as the examples used to do.
+
+    python preprocessing.py --iterations 200
+"""
+import argparse
+import io
+
+import torch
+from PIL import Image
+from torchvision import transforms
+
+import bench_utils
+
+ImagePreprocessor = bench_utils.import_example("rest", "serving_utils").ImagePreprocessor
+
+
+def per_request_transforms(input_image: Image.Image) -> torch.Tensor:
+    preprocess = transforms.Compose([
+        transforms.Resize(256),
+        transforms.CenterCrop(224),
+        transforms.ToTensor(),
+        transforms.Normalize(mean=[0.485, 0.456, 0.406],
+                             std=[0.229, 0.224, 0.225]),
+    ])
+    return preprocess(input_image)
+
+
+def per_request_preprocess(raw_img_data: bytes) -> torch.Tensor:
+    return per_request_transforms(Image.open(io.BytesIO(raw_img_data)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--iterations", type=int, default=200)
+    args = parser.parse_args()
+
+    preprocessor = ImagePreprocessor()
+    image = bench_utils.sample_image_bytes()
+    # The decoded image is shared by both pipelines so only the transforms are compared.
+    decoded = Image.open(io.BytesIO(image)).convert("RGB")
+    diff = (per_request_preprocess(image) - preprocessor(image)).abs().max().item()
+    print(f"max abs difference: {diff:.2e}")
+
+    print(f"{'pipeline':>24} {'mean ms':>8} {'p50 ms':>8} {'p99 ms':>8}")
+    cases = {
+        "per-request end to end": lambda: per_request_preprocess(image),
+        "prebuilt end to end": lambda: preprocessor(image),
+        "per-request transforms": lambda: per_request_transforms(decoded),
+        "prebuilt transforms": lambda: preprocessor.transform(decoded),
+    }
+    for name, fn in cases.items():
+        stats = bench_utils.summarize(bench_utils.timeit(fn, args.iterations, warmup=5))
+        print(f"{name:>24} {stats['mean_ms']:>8.3f} {stats['p50_ms']:>8.3f} {stats['p99_ms']:>8.3f}")
+
+
+if __name__ == "__main__":
+    main()
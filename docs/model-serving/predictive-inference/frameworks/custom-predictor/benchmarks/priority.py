@@ -0,0 +1,179 @@
+"""Measure the latency of interactive requests next to a bulk scoring job, with
+and without priority classes.
+
+The REST or gRPC model server is started on localhost with randomly
+initialized weights. A bulk job keeps --bulk_concurrency requests in flight,
+while interactive requests arrive at a fixed --rate, each measured from the
+time it was scheduled. The load runs twice: first with the bulk requests sent
+without a priority, so that both share the queues of the model server, then
+with the bulk requests sent as x-request-priority: bulk.
+
+    python priority.py --variant rest --rate 4 --bulk_concurrency 16 --duration 20
+
+Reports the latency percentiles and the throughput of both classes in both
+runs. Further model server arguments follow --server_args, e.g.
+--server_args --bulk_batch_size 16 --executor_workers 2.
+"""
+import argparse
+import asyncio
+import json
+import os
+import tempfile
+import time
+from typing import Dict, Optional
+
+import httpx
+import torch
+from kserve import InferInput, InferRequest
+from kserve.inference_client import InferenceGRPCClient
+from torchvision import models
+
+import bench_utils
+
+PERCENTILES = [50, 90, 99, 100]
+PRIORITY_HEADER = "x-request-priority"
+
+
+class Client:
+    """Sends a single image to the REST or gRPC predictor, with the priority
+    as a header or as gRPC metadata."""
+
+    def __init__(self, variant: str, http_port: int, grpc_port: int, image: bytes):
+        self.variant = variant
+        self.image = image
+        if variant == "grpc":
+            self.client = InferenceGRPCClient(url=f"127.0.0.1:{grpc_port}", timeout=120)
+        else:
+            self.url = f"http://127.0.0.1:{http_port}/v1/models/custom-model:predict"
+            self.client = httpx.AsyncClient(timeout=120, limits=httpx.Limits(max_connections=None))
+            self.payload = json.dumps(bench_utils.b64_payload([image])).encode()
+
+    async def send(self, priority: Optional[str]):
+        headers = {} if priority is None else {PRIORITY_HEADER: priority}
+        if self.variant == "grpc":
+            infer_input = InferInput(name="input-0", shape=[1], datatype="BYTES", data=[self.image])
+            await self.client.infer(
+                InferRequest(infer_inputs=[infer_input], model_name="custom-model"),
+                headers=list(headers.items()),
+            )
+        else:
+            response = await self.client.post(
+                self.url, content=self.payload, headers={"content-type": "application/json", **headers}
+            )
+            response.raise_for_status()
+
+    async def close(self):
+        if self.variant == "grpc":
+            await self.client.close()
+        else:
+            await self.client.aclose()
+
+
+async def mixed_load(client: Client, rate: float, duration: float, bulk_concurrency: int,
+                     bulk_priority: Optional[str]) -> Dict[str, Dict]:
+    """Send interactive requests at rate per second for duration seconds next
+    to bulk_concurrency bulk requests in flight, and return the latencies in
+    milliseconds and the errors of each class."""
+    results = {name: {"latencies": [], "errors": 0} for name in ["interactive", "bulk"]}
+    stop = asyncio.Event()
+
+    async def send(name: str, priority: Optional[str], scheduled: float):
+        try:
+            await client.send(priority)
+        except Exception:
+            results[name]["errors"] += 1
+            return
+        results[name]["latencies"].append((time.perf_counter() - scheduled) * 1000)
+
+    async def bulk_worker():
+        while not stop.is_set():
+            await send("bulk", bulk_priority, time.perf_counter())
+
+    async def interactive():
+        # Every request is sent on time, however long the earlier ones take.
+        tasks = []
+        for i in range(int(rate * duration)):
+            scheduled = start + i / rate
+            await asyncio.sleep(max(0.0, scheduled - time.perf_counter()))
+            tasks.append(asyncio.create_task(send("interactive", "interactive", scheduled)))
+        await asyncio.gather(*tasks)
+        stop.set()
+
+    start = time.perf_counter()
+    await asyncio.gather(interactive(), *[bulk_worker() for _ in range(bulk_concurrency)])
+    seconds = time.perf_counter() - start
+    for result in results.values():
+        result["requests_per_second"] = len(result["latencies"]) / seconds
+    return results
+
+
+def report(run: str, results: Dict[str, Dict]):
+    for name, result in results.items():
+        if result["latencies"]:
+            values = " ".join(
+                f"{bench_utils.percentile(result['latencies'], pct):>8.1f}" for pct in PERCENTILES
+            )
+        else:
+            values = " ".join(f"{'-':>8}" for _ in PERCENTILES)
+        print(f"{run:>8} {name:>11} {values} {result['requests_per_second']:>7.1f} {result['errors']:>6}")
+
+
+async def run(args):
+    http_port, grpc_port = bench_utils.free_port(), bench_utils.free_port()
+    with tempfile.TemporaryDirectory() as directory:
+        model_path = os.path.join(directory, "alexnet.pt")
+        torch.save(models.alexnet().state_dict(), model_path)
+        process = bench_utils.start_server(
+            args.variant, http_port, ["--model_path", model_path] + args.server_args,
+            grpc_port=grpc_port,
+        )
+        try:
+            ready = f"http://127.0.0.1:{http_port}/v1/models/custom-model"
+            if not bench_utils.wait_ok(process, ready, time.monotonic() + args.timeout):
+                raise RuntimeError(f"The {args.variant} model server did not get ready")
+            client = Client(args.variant, http_port, grpc_port, bench_utils.sample_image_bytes())
+            try:
+                for _ in range(args.warmup):
+                    await client.send(None)
+                print(f"{'run':>8} {'class':>11} " + " ".join(
+                    f"{'max' if pct == 100 else f'p{pct}':>8}" for pct in PERCENTILES
+                ) + f" {'req/s':>7} {'errors':>6}")
+                for run_name, bulk_priority in [("fifo", None), ("priority", "bulk")]:
+                    results = await mixed_load(
+                        client, args.rate, args.duration, args.bulk_concurrency, bulk_priority
+                    )
+                    report(run_name, results)
+            finally:
+                await client.close()
+        finally:
+            process.terminate()
+            try:
+                process.wait(timeout=30)
+            except Exception:
+                process.kill()
+                process.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--variant", default="rest", choices=["rest", "grpc"])
+    parser.add_argument("--rate", type=float, default=4,
+                        help="The interactive requests per second.")
+    parser.add_argument("--bulk_concurrency", type=int, default=16,
+                        help="The bulk requests kept in flight.")
+    parser.add_argument("--duration", type=float, default=20,
+                        help="The seconds of every run.")
+    parser.add_argument("--warmup", type=int, default=10)
+    parser.add_argument("--timeout", type=float, default=300)
+    parser.add_argument(
+        "--server_args", nargs=argparse.REMAINDER, default=[],
+        help="Further arguments of the model server, must come last.",
+    )
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""Compare the fp32 AlexNetModel against its dynamically quantized int8
+variant: top-5 agreement on a sample set, forward latency and weight size.
+
+    python quantization.py --batch_sizes 1 8 --iterations 20
+    python quantization.py --images ~/imagenet-sample
+
+The agreement is only meaningful with the pretrained weights, pass
+--random_weights to measure latency and size without downloading them.
+"""
+import argparse
+import io
+
+import torch
+
+import bench_utils
+
+AlexNetModel = bench_utils.import_example("rest", "model").AlexNetModel
+
+
+def weights_mb(model: torch.nn.Module) -> float:
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.getbuffer().nbytes / 2**20
+
+
+def top5_agreement(fp32: AlexNetModel, int8: AlexNetModel, images):
+    """Return the fraction of the fp32 top-5 classes the int8 model also
+    ranks in its top-5, and how often both agree on the top-1 class."""
+    overlap, top1 = 0, 0
+    for image in images.values():
+        batch = fp32.pipeline.preprocessor(image).unsqueeze(0)
+        expected = fp32.pipeline.forward(batch).topk(5).indices[0].tolist()
+        actual = int8.pipeline.forward(batch).topk(5).indices[0].tolist()
+        overlap += len(set(expected) & set(actual))
+        top1 += expected[0] == actual[0]
+    return overlap / (5 * len(images)), top1 / len(images)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--images", help="Directory of images to check the top-5 agreement on.")
+    parser.add_argument("--batch_sizes", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--iterations", type=int, default=20)
+    parser.add_argument("--random_weights", action="store_true")
+    args = parser.parse_args()
+
+    model_cls = bench_utils.random_weights(AlexNetModel) if args.random_weights else AlexNetModel
+    # Seed the random weights so that both models start from the same ones.
+    torch.manual_seed(0)
+    fp32 = model_cls("custom-model")
+    fp32.load()
+    torch.manual_seed(0)
+    int8 = model_cls("custom-model", dynamic_quantization=True)
+    int8.load()
+    images = bench_utils.sample_image_set(args.images)
+
+    overlap, top1 = top5_agreement(fp32, int8, images)
+    print(f"images: {len(images)}  top-5 agreement: {overlap:.1%}  top-1 agreement: {top1:.1%}")
+    print(f"weights MB  fp32: {weights_mb(fp32.pipeline.model):.1f}  int8: {weights_mb(int8.pipeline.model):.1f}")
+
+    print(f"{'batch':>5} {'fp32 ms':>8} {'int8 ms':>8} {'speedup':>8}")
+    for batch_size in args.batch_sizes:
+        batch = torch.randn(batch_size, 3, 224, 224)
+        fp32_ms = bench_utils.summarize(bench_utils.timeit(lambda: fp32.pipeline.forward(batch), args.iterations))
+        int8_ms = bench_utils.summarize(bench_utils.timeit(lambda: int8.pipeline.forward(batch), args.iterations))
+        print(
+            f"{batch_size:>5} {fp32_ms['mean_ms']:>8.2f} {int8_ms['mean_ms']:>8.2f} "
+            f"{fp32_ms['mean_ms'] / int8_ms['mean_ms']:>7.2f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
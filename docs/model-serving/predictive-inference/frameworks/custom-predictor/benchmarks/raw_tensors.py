@@ -0,0 +1,98 @@
+"""Compare FP32 tensor inputs and outputs sent as typed fp32_contents values
+against raw_input_contents / raw_output_contents bytes in the gRPC predictor,
+for batches of preprocessed [N, 3, 224, 224] images.
+
+    python raw_tensors.py --batch_sizes 1 8 32 64
+
+Times the protobuf (de)serialization and the conversion between tensors and
+kserve types on both ends, without a model server or forward pass: encoding
+the request on the client, decoding it into a tensor on the server, and
+encoding and decoding the [N, 5] response. The typed path decodes the input as
+the predictor used to, with torch.Tensor(np_array) and get_predict_response.
+"""
+import argparse
+import time
+
+import numpy as np
+import torch
+from kserve import InferInput, InferRequest, InferResponse
+from kserve.protocol.grpc.grpc_predict_v2_pb2 import ModelInferRequest, ModelInferResponse
+from kserve.utils.utils import get_predict_response
+
+import bench_utils
+
+serving_utils = bench_utils.import_example("grpc", "serving_utils")
+
+
+def encode_request(batch: np.ndarray, raw: bool) -> bytes:
+    infer_input = InferInput(name="input-0", shape=list(batch.shape), datatype="FP32")
+    infer_input.set_data_from_numpy(batch, binary_data=raw)
+    request = InferRequest(infer_inputs=[infer_input], model_name="custom-model")
+    return request.to_grpc().SerializeToString()
+
+
+def decode_request(message: bytes, raw: bool):
+    request = InferRequest.from_grpc(ModelInferRequest.FromString(message))
+    if raw:
+        return request, serving_utils.fp32_tensor(request.inputs[0])
+    return request, torch.Tensor(request.inputs[0].as_numpy())
+
+
+def encode_response(request: InferRequest, output: torch.Tensor, raw: bool) -> bytes:
+    if raw:
+        response = serving_utils.fp32_response(request, output, "custom-model")
+    else:
+        response = get_predict_response(request, output.numpy(), "custom-model")
+    return response.to_grpc().SerializeToString()
+
+
+def decode_response(message: bytes) -> np.ndarray:
+    response = InferResponse.from_grpc(ModelInferResponse.FromString(message))
+    return response.outputs[0].as_numpy()
+
+
+def measure(batch_size: int, raw: bool, iterations: int):
+    batch = np.random.rand(batch_size, 3, 224, 224).astype(np.float32)
+    output = torch.rand(batch_size, 5)
+    request_message = encode_request(batch, raw)
+    request, tensor = decode_request(request_message, raw)
+    assert torch.equal(tensor, torch.from_numpy(batch))
+    response_message = encode_response(request, output, raw)
+    assert np.array_equal(decode_response(response_message), output.numpy())
+    stages = {
+        "encode request": lambda: encode_request(batch, raw),
+        "decode request": lambda: decode_request(request_message, raw),
+        "encode response": lambda: encode_response(request, output, raw),
+        "decode response": lambda: decode_response(response_message),
+    }
+    cpu = time.process_time()
+    timings = {
+        name: bench_utils.summarize(bench_utils.timeit(fn, iterations))["mean_ms"]
+        for name, fn in stages.items()
+    }
+    cpu_ms = (time.process_time() - cpu) * 1000 / (iterations + 1)
+    return len(request_message), len(response_message), timings, cpu_ms
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--batch_sizes", nargs="+", type=int, default=[1, 8, 32, 64])
+    parser.add_argument("--iterations", type=int, default=10)
+    args = parser.parse_args()
+
+    stages = ["encode request", "decode request", "encode response", "decode response"]
+    print(f"{'batch':>5} {'contents':>8} {'request MB':>10} {'response B':>10} "
+          + " ".join(f"{stage + ' ms':>18}" for stage in stages) + f" {'cpu ms':>8}")
+    for batch_size in args.batch_sizes:
+        for raw in [False, True]:
+            request_size, response_size, timings, cpu_ms = measure(batch_size, raw, args.iterations)
+            print(
+                f"{batch_size:>5} {'raw' if raw else 'typed':>8} {request_size / 2**20:>10.1f} "
+                f"{response_size:>10} "
+                + " ".join(f"{timings[stage]:>18.2f}" for stage in stages)
+                + f" {cpu_ms:>8.1f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+"""Report the resident (RSS) and proportional (PSS) memory of each process
+of the REST model server running with --workers, with and without
+--share_weights.
+
+    python worker_memory.py --workers 4
+    python worker_memory.py --workers 4 --server_args --dynamic_quantization
+
+PSS splits every shared page between the processes mapping it, so the sum of
+PSS is what the pod actually uses. Without --share_weights PyTorch passes the
+weights to the workers through /dev/shm, which fails for quantized models. Randomly initialized weights are exported
+to a temporary file and served with --model_path. Only available on Linux.
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+import urllib.request
+from typing import Dict, List
+
+import torch
+from torchvision import models
+
+import bench_utils
+
+
+def memory_mb(pid: int) -> Dict[str, float]:
+    memory = {}
+    with open(f"/proc/{pid}/smaps_rollup") as smaps:
+        for line in smaps:
+            field, _, value = line.partition(":")
+            if field in ("Rss", "Pss"):
+                memory[field.lower()] = int(value.split()[0]) / 1024
+    return memory
+
+
+def workers_of(pid: int) -> List[int]:
+    """Return the uvicorn worker processes, leaving out the resource tracker
+    of multiprocessing."""
+    workers = []
+    for child in bench_utils.children(pid):
+        with open(f"/proc/{child}/cmdline", "rb") as cmdline:
+            if b"resource_tracker" not in cmdline.read():
+                workers.append(child)
+    return workers
+
+
+def settle(pid: int, workers: int, timeout: float) -> List[int]:
+    """Wait until all workers started and their memory stopped growing."""
+    deadline = time.monotonic() + timeout
+    last = None
+    while time.monotonic() < deadline:
+        pids = [pid] + workers_of(pid)
+        current = sum(memory_mb(p)["rss"] for p in pids)
+        if len(pids) == workers + 1 and last is not None and abs(current - last) < 1:
+            return pids
+        last = current
+        time.sleep(1)
+    raise RuntimeError("The model server workers did not settle")
+
+
+def measure(workers: int, extra_args: List[str], timeout: float):
+    http_port = bench_utils.free_port()
+    process = bench_utils.start_server(
+        "rest", http_port, ["--workers", str(workers)] + extra_args
+    )
+    try:
+        url = f"http://127.0.0.1:{http_port}/v1/models/custom-model"
+        if not bench_utils.wait_ok(process, url, time.monotonic() + timeout):
+            raise RuntimeError("The model server did not get ready")
+        # Every worker is ready once enough requests were spread across them.
+        payload = json.dumps(bench_utils.b64_payload([bench_utils.sample_image_bytes()])).encode()
+        for _ in range(4 * workers):
+            request = urllib.request.Request(
+                url + ":predict", payload, {"content-type": "application/json"}
+            )
+            urllib.request.urlopen(request, timeout=timeout).read()
+        pids = settle(process.pid, workers, timeout)
+        names = ["parent"] + [f"worker {i}" for i in range(workers)]
+        return [(name, memory_mb(pid)) for name, pid in zip(names, pids)]
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--timeout", type=float, default=300)
+    parser.add_argument(
+        "--server_args", nargs=argparse.REMAINDER, default=[],
+        help="Further arguments of the model server, must come last.",
+    )
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        model_path = os.path.join(directory, "alexnet.pt")
+        torch.save(models.alexnet().state_dict(), model_path)
+        cases = {
+            "pickled": ["--model_path", model_path],
+            "share_weights": ["--model_path", model_path, "--share_weights"],
+        }
+        for name, extra_args in cases.items():
+            print(f"{name}:")
+            try:
+                processes = measure(args.workers, extra_args + args.server_args, args.timeout)
+            except RuntimeError as e:
+                print(f"  {e}")
+                continue
+            total = 0.0
+            for process, memory in processes:
+                total += memory["pss"]
+                print(f"  {process:>10} rss {memory['rss']:>7.1f} MB  pss {memory['pss']:>7.1f} MB")
+            print(f"  {'total':>10} {'':>18} pss {total:>7.1f} MB")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,23 +1,325 @@
+import argparse
 import asyncio
+import collections
 import json
 import base64
+import math
 import os
+import time
+from typing import List, Optional, Set, Tuple
 
+import grpc
 from kserve import InferRequest, InferInput
 from kserve.inference_client import InferenceGRPCClient
+from kserve.protocol.grpc.grpc_predict_v2_pb2 import ModelInferRequest, ModelInferResponse
+
+STREAM_METHOD = "/inference.GRPCInferenceService/ModelStreamInfer"
+COMPRESSION = {
+    "none": grpc.Compression.NoCompression,
+    "gzip": grpc.Compression.Gzip,
+    "deflate": grpc.Compression.Deflate,
+}
+
+
+def channel_options(compression: str = "none", max_message_bytes: int = -1, keepalive_ms: int = 0,
+                    window_bytes: int = 0):
+    """Return the channel arguments compressing the requests, the max message
+    size in both directions, the keepalive pings and the HTTP/2 window."""
+    options = [
+        ('grpc.default_compression_algorithm', COMPRESSION[compression]),
+        ('grpc.max_send_message_length', max_message_bytes),
+        ('grpc.max_receive_message_length', max_message_bytes),
+    ]
+    if keepalive_ms:
+        # The server must accept pings this often, see --grpc_keepalive_ms.
+        options += [
+            ('grpc.keepalive_time_ms', keepalive_ms),
+            ('grpc.keepalive_timeout_ms', 20_000),
+            ('grpc.keepalive_permit_without_calls', 1),
+            ('grpc.http2.max_pings_without_data', 0),
+        ]
+    if window_bytes:
+        options += [('grpc.http2.lookahead_bytes', window_bytes), ('grpc.http2.bdp_probe', 0)]
+    return options
+
+
+def load_images(directory: str = None) -> List[bytes]:
+    """Read the images of a directory, or the image of input.json, into memory once."""
+    if directory is None:
+        with open("../input.json") as json_file:
+            data = json.load(json_file)
+        return [base64.b64decode(data["instances"][0]["image"]["b64"])]
+    images = []
+    for name in sorted(os.listdir(directory)):
+        with open(os.path.join(directory, name), "rb") as image_file:
+            images.append(image_file.read())
+    return images
+
+
+def make_requests(images: List[bytes], batch_size: int, model_name: str) -> List[InferRequest]:
+    """Build a request per image, carrying it and the batch_size - 1 images
+    following it as one BYTES input of shape [batch_size]."""
+    requests = []
+    for i in range(len(images)):
+        batch = [images[(i + j) % len(images)] for j in range(batch_size)]
+        infer_input = InferInput(name="input-0", shape=[len(batch)], datatype="BYTES", data=batch)
+        requests.append(InferRequest(infer_inputs=[infer_input], model_name=model_name))
+    return requests
+
+
+def print_histogram(latencies: List[float], seconds: float, errors: int, batch_size: int = 1):
+    """Print the latencies in milliseconds in buckets doubling in size, with
+    percentiles and the throughput."""
+    ordered = sorted(latencies)
+    buckets = {}
+    for latency in ordered:
+        upper = 2 ** max(0, math.ceil(math.log2(max(latency, 1e-3))))
+        buckets[upper] = buckets.get(upper, 0) + 1
+    width = max(buckets.values())
+    for upper, count in sorted(buckets.items()):
+        print(f"{upper // 2:>6} - {upper:<6} ms {count:>7} {'#' * round(40 * count / width)}")
+    for pct in [50, 90, 99, 99.9]:
+        value = ordered[min(len(ordered) - 1, math.ceil(pct / 100 * len(ordered)) - 1)]
+        print(f"p{pct}: {value:.2f} ms")
+    print(f"{len(latencies)} requests in {seconds:.2f} s, {len(latencies) / seconds:.1f} requests/s, "
+          f"{len(latencies) * batch_size / seconds:.1f} images/s, {errors} errors")
+
+
+class Hedger:
+    """Sends a duplicate of a request that is still pending after the given
+    percentile of the recent latencies to the next channel. The first reply
+    wins. A duplicate is cancelled once the request answered, while the
+    request runs on after its duplicate answered first: the percentile is
+    taken over the latencies of the requests themselves, the faster replies
+    of their duplicates would lower it and hedge ever more requests."""
+
+    def __init__(self, percentile: float, min_samples: int = 20, window: int = 1000):
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.recent = collections.deque(maxlen=window)
+        self.requests = 0
+        self.fired = 0
+        self.won = 0
+        self._outrun: Set[asyncio.Task] = set()
+
+    def delay(self) -> Optional[float]:
+        """The delay in seconds before a duplicate is sent, None until enough
+        latencies were seen."""
+        if len(self.recent) < self.min_samples:
+            return None
+        ordered = sorted(self.recent)
+        return ordered[min(len(ordered) - 1, math.ceil(self.percentile / 100 * len(ordered)) - 1)]
+
+    async def infer(self, clients: List[InferenceGRPCClient], index: int, request: InferRequest,
+                    timeout: float = 60, headers: Optional[List[Tuple[str, str]]] = None):
+        self.requests += 1
+        start = time.perf_counter()
+        calls = [asyncio.create_task(clients[index].infer(infer_request=request, timeout=timeout, headers=headers))]
+        calls[0].add_done_callback(lambda call: self._record(call, start))
+        outrun = False
+        try:
+            done, _ = await asyncio.wait(calls, timeout=self.delay())
+            # The duplicate gets what is left of the deadline.
+            remaining = timeout - (time.perf_counter() - start)
+            if not done and remaining > 0:
+                self.fired += 1
+                duplicate = clients[(index + 1) % len(clients)]
+                calls.append(asyncio.create_task(
+                    duplicate.infer(infer_request=request, timeout=remaining, headers=headers)
+                ))
+            pending = set(calls)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for call in done:
+                    if call.exception() is None:
+                        outrun = call is not calls[0]
+                        self.won += outrun
+                        return call.result()
+                    error = call.exception()
+            raise error
+        finally:
+            for call in calls[1:]:
+                call.cancel()
+            if outrun:
+                self._outrun.add(calls[0])
+                calls[0].add_done_callback(self._outrun.discard)
+            else:
+                calls[0].cancel()
+
+    def _record(self, call: asyncio.Task, start: float):
+        if not call.cancelled() and call.exception() is None:
+            self.recent.append(time.perf_counter() - start)
+
+    def summary(self) -> str:
+        return (f"hedged {self.fired} of {self.requests} requests ({100 * self.fired / max(1, self.requests):.1f}%) "
+                f"after p{self.percentile:g}, the duplicate answered first {self.won} times")
+
+
+async def run_load(clients: List[InferenceGRPCClient], requests: List[InferRequest], total: int, in_flight: int,
+                   timeout: float = 60, hedger: Optional[Hedger] = None,
+                   headers: Optional[List[Tuple[str, str]]] = None):
+    """Keep in_flight requests outstanding on every channel until total
+    requests were sent, each failing after timeout seconds and sent with the
+    headers as metadata."""
+    latencies = []
+    errors = 0
+    sent = 0
+
+    async def worker(index: int):
+        nonlocal errors, sent
+        while sent < total:
+            request = requests[sent % len(requests)]
+            sent += 1
+            start = time.perf_counter()
+            try:
+                if hedger is not None:
+                    await hedger.infer(clients, index, request, timeout, headers)
+                else:
+                    await clients[index].infer(infer_request=request, timeout=timeout, headers=headers)
+            except Exception:
+                errors += 1
+                continue
+            latencies.append((time.perf_counter() - start) * 1000)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[worker(index) for index in range(len(clients)) for _ in range(in_flight)])
+    return latencies, time.perf_counter() - start, errors
+
+
+async def run_stream(channels: List[grpc.aio.Channel], requests: List[ModelInferRequest], total: int,
+                     in_flight: int, headers: Optional[List[Tuple[str, str]]] = None):
+    """Send total requests as the messages of a ModelStreamInfer stream per
+    channel, opened with the headers as metadata, with up to in_flight
+    messages of every stream awaiting their response."""
+    latencies = []
+    errors = 0
+    sent = 0
+
+    async def stream(channel: grpc.aio.Channel):
+        nonlocal errors
+        call = channel.stream_stream(
+            STREAM_METHOD,
+            request_serializer=ModelInferRequest.SerializeToString,
+            response_deserializer=ModelInferResponse.FromString,
+        )(metadata=headers)
+        window = asyncio.Semaphore(in_flight)
+        send_times = collections.deque()
+
+        async def send():
+            nonlocal sent
+            while sent < total:
+                await window.acquire()
+                if sent >= total:
+                    break
+                request = requests[sent % len(requests)]
+                sent += 1
+                send_times.append(time.perf_counter())
+                # Waits while the server is not reading, it stops reading
+                # while its batches are full.
+                await call.write(request)
+            await call.done_writing()
+
+        writer = asyncio.create_task(send())
+        try:
+            # Responses arrive in the order of the requests.
+            async for _ in call:
+                latencies.append((time.perf_counter() - send_times.popleft()) * 1000)
+                window.release()
+            await writer
+        except grpc.aio.AioRpcError as e:
+            print(f"Stream failed: {e.code().name} {e.details()}")
+            errors += len(send_times)
+            writer.cancel()
+
+    start = time.perf_counter()
+    await asyncio.gather(*[stream(channel) for channel in channels])
+    return latencies, time.perf_counter() - start, errors
 
 
 async def main():
-    client = InferenceGRPCClient(
-        url=os.environ.get("INGRESS_HOST", "localhost") + ":" + os.environ.get("INGRESS_PORT", "8081"),
-        channel_args=[('grpc.ssl_target_name_override', os.environ.get("SERVICE_HOSTNAME", ""))]
-    )
-    with open("../input.json") as json_file:
-        data = json.load(json_file)
-    infer_input = InferInput(name="input-0", shape=[1], datatype="BYTES",
-                             data=[base64.b64decode(data["instances"][0]["image"]["b64"])])
-    request = InferRequest(infer_inputs=[infer_input], model_name=os.environ.get("MODEL_NAME", "custom-model"))
-    res = await client.infer(infer_request=request)
-    print(res)
-
-asyncio.run(main())
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=1,
+                        help="The number of requests, a single request prints the response.")
+    parser.add_argument("--channels", type=int, default=1,
+                        help="The number of gRPC channels, each with its own connection.")
+    parser.add_argument("--in_flight", type=int, default=1,
+                        help="The number of requests kept in flight on every channel.")
+    parser.add_argument("--batch_size", type=int, default=1,
+                        help="The number of images sent in every request.")
+    parser.add_argument("--images", default=None,
+                        help="A directory of images to send, by default the image of input.json.")
+    parser.add_argument("--stream", action="store_true",
+                        help="Send the requests as the frames of a ModelStreamInfer stream per channel, "
+                             "to the --stream_port of the model server at STREAM_PORT.")
+    parser.add_argument("--deadline_ms", type=float, default=None,
+                        help="The deadline of every request, including its duplicate, by default 60 s.")
+    parser.add_argument("--hedge_percentile", type=float, default=None,
+                        help="Send a duplicate of a request to the next channel when it is still pending after "
+                             "this percentile of the recent latencies, e.g. 95.")
+    parser.add_argument("--compression", default="none", choices=list(COMPRESSION),
+                        help="Compress the requests, the server compresses its responses with --grpc_compression.")
+    parser.add_argument("--max_message_bytes", type=int, default=-1,
+                        help="The max size of the requests and the responses, -1 is unlimited.")
+    parser.add_argument("--keepalive_ms", type=int, default=0,
+                        help="Ping the server every so many milliseconds, 0 never.")
+    parser.add_argument("--window_bytes", type=int, default=0,
+                        help="A fixed HTTP/2 flow control window per call, 0 sizes it from the bandwidth-delay product.")
+    parser.add_argument("--priority", default=None, choices=["interactive", "bulk"],
+                        help="The priority class of the requests, sent as x-request-priority metadata.")
+    args = parser.parse_args()
+
+    model_name = os.environ.get("MODEL_NAME", "custom-model")
+    channel_args = [
+        ('grpc.ssl_target_name_override', os.environ.get("SERVICE_HOSTNAME", "")),
+        # Channels to the same target share their connection unless every
+        # channel has a subchannel pool of its own.
+        ('grpc.use_local_subchannel_pool', 1),
+    ] + channel_options(args.compression, args.max_message_bytes, args.keepalive_ms, args.window_bytes)
+    requests = make_requests(load_images(args.images), args.batch_size, model_name)
+    headers = None if args.priority is None else [("x-request-priority", args.priority)]
+    if args.stream:
+        url = os.environ.get("INGRESS_HOST", "localhost") + ":" + os.environ.get("STREAM_PORT", "8082")
+        channels = [grpc.aio.insecure_channel(url, options=channel_args) for _ in range(args.channels)]
+        messages = [request.to_grpc() for request in requests]
+        try:
+            latencies, seconds, errors = await run_stream(channels, messages, args.requests, args.in_flight,
+                                                          headers)
+            if latencies:
+                print_histogram(latencies, seconds, errors, args.batch_size)
+            else:
+                print(f"All {errors} frames failed")
+        finally:
+            for channel in channels:
+                await channel.close()
+        return
+
+    clients = [
+        InferenceGRPCClient(
+            url=os.environ.get("INGRESS_HOST", "localhost") + ":" + os.environ.get("INGRESS_PORT", "8081"),
+            channel_args=channel_args,
+        )
+        for _ in range(args.channels)
+    ]
+    hedger = None if args.hedge_percentile is None else Hedger(args.hedge_percentile)
+    try:
+        timeout = 60 if args.deadline_ms is None else args.deadline_ms / 1000
+        if args.requests == 1:
+            res = await clients[0].infer(infer_request=requests[0], timeout=timeout, headers=headers)
+            # The outputs are sent as raw_output_contents, as_numpy() decodes them.
+            print(res.outputs[0].as_numpy())
+            return
+        latencies, seconds, errors = await run_load(clients, requests, args.requests, args.in_flight,
+                                                    timeout, hedger, headers)
+        if latencies:
+            print_histogram(latencies, seconds, errors, args.batch_size)
+        else:
+            print(f"All {errors} requests failed")
+        if hedger is not None:
+            print(hedger.summary())
+    finally:
+        for client in clients:
+            await client.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,69 +1,171 @@
 import argparse
-import io
-from typing import Dict
+import functools
+from typing import Any, Dict, Sequence, Tuple
 
+import grpc
 import torch
-from PIL import Image
-from torchvision import models, transforms
+from grpc_interceptor.exceptions import GrpcException
+from torchvision import models
 
 from kserve import InferRequest, InferResponse, Model, ModelServer, logging, model_server
-from kserve.utils.utils import get_predict_response
+from kserve.errors import InvalidInput, ModelNotReady
+
+from serving_utils import (
+    InferencePipeline,
+    StreamServer,
+    TunedGRPCServer,
+    bytes_input,
+    fp32_response,
+    fp32_tensor,
+    grpc_options,
+    grpc_parser,
+    pipeline_options,
+    pipeline_parser,
+    worker_parser,
+    profiler_router,
+)
+
 
 # This custom predictor example implements the custom model following KServe
 # v2 inference gPPC protocol, the input can be raw image bytes or image tensor
 # which is pre-processed by transformer and then passed to predictor, the
 # output is the prediction response.
 class AlexNetModel(Model):
-    def __init__(self, name: str):
-        super().__init__(name)
-        self.load()
+    def __init__(
+        self,
+        name: str,
+        background_load: bool = False,
+        stream_port: int = 0,
+        stream_batch_size: int = 8,
+        stream_options: Sequence[Tuple[str, Any]] = (),
+        **options,
+    ):
+        super().__init__(name, return_response_headers=True)
+        # The pipeline loads the model and runs its forward passes on an
+        # executor, the event loop keeps serving health probes and parsing
+        # requests in the meantime. Batching, caching and load shedding are
+        # opt-in features of the pipeline, all off with the default options.
+        self.pipeline = InferencePipeline(name, models.alexnet, **options)
         self.ready = False
+        # With background_load the model server binds its ports right away and
+        # start_engine() loads and warms up the model in the background,
+        # healthy() only reports the model ready once the warm-up succeeded.
+        self.engine = background_load or stream_port > 0
+        self.warm = not background_load
+        # With a stream_port start_engine() also serves the ModelStreamInfer
+        # streaming RPC, on a gRPC server of its own.
+        self.stream_server = None
+        if stream_port:
+            self.stream_server = StreamServer(
+                self.pipeline, stream_port, stream_batch_size, stream_options
+            )
 
     def load(self):
-        self.model = models.alexnet(pretrained=True)
-        self.model.eval()
+        # load() is idempotent, the model server may call it again on a model
+        # that is already loaded, or while start_engine() loads it in the
+        # background, which is the case while the model is not warm.
+        if self.pipeline.model is not None or not self.warm:
+            return
+        self.pipeline.load()
         # The ready flag is used by model ready endpoint for readiness probes,
         # set to True when model is loaded successfully without exceptions.
         self.ready = True
 
+    async def start_engine(self):
+        if not self.warm:
+            await self.pipeline.load_in_background()
+            self.warm = True
+        if self.stream_server is not None:
+            await self.stream_server.serve()
+
+    def stop_engine(self):
+        super().stop_engine()
+        if self.stream_server is not None:
+            self.stream_server.stop()
+
+    async def healthy(self) -> bool:
+        return self.ready and self.warm
+
     async def predict(
         self, payload: InferRequest,
         headers: Dict[str, str] = None,
         response_headers: Dict[str, str] = None,
     ) -> InferResponse:
-        req = payload.inputs[0]
-        if req.datatype == "BYTES":
-            input_image = Image.open(io.BytesIO(req.data[0]))
-            preprocess = transforms.Compose(
-                [
-                    transforms.Resize(256),
-                    transforms.CenterCrop(224),
-                    transforms.ToTensor(),
-                    transforms.Normalize(
-                        mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]
-                    ),
-                ]
-            )
-            input_tensor = preprocess(input_image)
-            input_tensor = input_tensor.unsqueeze(0)
-        elif req.datatype == "FP32":
-            np_array = payload.inputs[0].as_numpy()
-            input_tensor = torch.Tensor(np_array)
+        # With background_load the model server accepts requests while the
+        # model is still loading, they are answered with 503 or UNAVAILABLE.
+        if not await self.healthy():
+            if payload.from_grpc:
+                raise GrpcException(f"Model {self.name} is not ready", grpc.StatusCode.UNAVAILABLE)
+            raise ModelNotReady(self.name)
+        with self.pipeline.request(headers, payload.from_grpc) as timer:
+            req = payload.inputs[0]
+            if req.datatype == "BYTES":
+                # All N images of a [N] input are decoded concurrently on the
+                # executor and run through the model as one batch.
+                output = await self.pipeline.infer_images(bytes_input(req), timer)
+            elif req.datatype == "FP32":
+                input_tensor = fp32_tensor(req)
+                with timer.stage("forward"):
+                    output = await self.pipeline.submit(input_tensor)
+            else:
+                raise InvalidInput(f"Unsupported input datatype {req.datatype}")
 
-        output = self.model(input_tensor)
-        torch.nn.functional.softmax(output, dim=1)
-        values, top_5 = torch.topk(output, 5)
-        result = values.detach().numpy()
-        return get_predict_response(payload, result, self.name)
+            with timer.stage("postprocess"):
+                torch.nn.functional.softmax(output, dim=1)
+                values, top_5 = torch.topk(output, 5)
+            with timer.stage("response"):
+                response = fp32_response(payload, values, self.name)
+            # gRPC clients receive the stage timings as a response parameter, the
+            # model server only passes response headers on to REST clients.
+            server_timing = timer.server_timing()
+            response.parameters = {"server_timing": server_timing}
+            if response_headers is not None:
+                response_headers["server-timing"] = server_timing
+            return response
 
 
-parser = argparse.ArgumentParser(parents=[model_server.parser])
+parser = argparse.ArgumentParser(
+    parents=[model_server.parser, pipeline_parser(), worker_parser(), grpc_parser()]
+)
 args, _ = parser.parse_known_args()
 
 if __name__ == "__main__":
     # Configure kserve and uvicorn logger
     if args.configure_logging:
         logging.configure_logging(args.log_config_file)
-    model = AlexNetModel(args.model_name)
-    model.load()
+    if args.background_load and args.workers > 1:
+        # The worker processes load the model before they bind the port.
+        parser.error("--background_load is not supported with --workers greater than 1")
+    grpc_server_options = grpc_options(
+        args.grpc_max_send_message_length,
+        args.grpc_max_receive_message_length,
+        args.grpc_compression,
+        args.grpc_keepalive_ms,
+        args.grpc_window_bytes,
+    )
+    # ModelServer creates its gRPC server from kserve.model_server.GRPCServer,
+    # which only sets the max message lengths.
+    model_server.GRPCServer = functools.partial(TunedGRPCServer, options=grpc_server_options)
+    model = AlexNetModel(
+        args.model_name,
+        processes=args.workers,
+        background_load=args.background_load,
+        share_weights=args.share_weights,
+        stream_port=args.stream_port,
+        stream_batch_size=args.stream_batch_size,
+        stream_options=grpc_server_options,
+        **pipeline_options(args),
+    )
+    if args.background_load:
+        # Registers the model with the model server, it is loaded by start_engine()
+        model.ready = True
+    else:
+        model.load()
+    if args.profiler_token_file:
+        # The admin route is served on the HTTP port of the model server
+        with open(args.profiler_token_file) as token_file:
+            token = token_file.read().strip()
+        model_server.app.include_router(
+            profiler_router(args.model_name, model.pipeline.profiler.capture, token)
+        )
     ModelServer().start([model])
@@ -1,67 +1,107 @@
 import argparse
 import base64
-import io
+import functools
 from typing import Dict
 
-from torchvision import models, transforms
+from torchvision import models
 import torch
-from PIL import Image
 from ray import serve
 from kserve import Model, ModelServer, logging, model_server
 from kserve.ray import RayModel
 
+from serving_utils import (
+    InferencePipeline,
+    RayMetrics,
+    pipeline_options,
+    pipeline_parser,
+    profiler_router,
+    replica_cpus,
+)
+
 
 # the model handle name should match the model endpoint name
 @serve.deployment(name="custom-model", num_replicas=1)
 class AlexNetModel(Model):
-    def __init__(self, name):
-        super().__init__(name)
+    def __init__(self, name, **options):
+        super().__init__(name, return_response_headers=True)
         self.ready = False
+        # The pipeline loads the model and runs its forward passes on an
+        # executor, the replica's event loop keeps accepting requests in the
+        # meantime. The CPUs Ray assigned to the replica, ray_actor_options
+        # num_cpus, are split between the forward passes that run concurrently.
+        # Its metrics are exported by the Ray metrics agent rather than the
+        # model server's /metrics endpoint.
+        self.pipeline = InferencePipeline(
+            name,
+            functools.partial(models.alexnet, progress=False),
+            cpus=replica_cpus(),
+            metrics=RayMetrics(name),
+            **options,
+        )
         self.load()
 
     def load(self):
-        self.model = models.alexnet(pretrained=True, progress=False)
-        self.model.eval()
+        # load() is idempotent, the model server may call it again on a model
+        # that is already loaded.
+        if self.ready:
+            return
+        self.pipeline.load()
         # The ready flag is used by model ready endpoint for readiness probes,
         # set to True when model is loaded successfully without exceptions.
         self.ready = True
 
-    async def predict(self, payload: Dict, headers: Dict[str, str] = None) -> Dict:
-        inputs = payload["instances"]
+    async def predict(
+        self,
+        payload: Dict,
+        headers: Dict[str, str] = None,
+        response_headers: Dict[str, str] = None,
+    ) -> Dict:
+        with self.pipeline.request(headers) as timer:
+            inputs = payload["instances"]
 
-        # Input follows the Tensorflow V1 HTTP API for binary values
-        # https://www.tensorflow.org/tfx/serving/api_rest#encoding_binary_values
-        data = inputs[0]["image"]["b64"]
-        raw_img_data = base64.b64decode(data)
-        input_image = Image.open(io.BytesIO(raw_img_data))
-        preprocess = transforms.Compose(
-            [
-                transforms.Resize(256),
-                transforms.CenterCrop(224),
-                transforms.ToTensor(),
-                transforms.Normalize(
-                    mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]
-                ),
-            ]
-        )
+            # Input follows the Tensorflow V1 HTTP API for binary values
+            # https://www.tensorflow.org/tfx/serving/api_rest#encoding_binary_values
+            with timer.stage("b64_decode"):
+                data = inputs[0]["image"]["b64"]
+                raw_img_data = base64.b64decode(data)
+            output = await self.pipeline.infer_images([raw_img_data], timer)
+            with timer.stage("postprocess"):
+                torch.nn.functional.softmax(output, dim=1)
+                values, top_5 = torch.topk(output, 5)
+                result = values.tolist()
+            with timer.stage("response"):
+                response = {"predictions": result}
+            # The response headers travel back to the model server with the response.
+            if response_headers is not None:
+                response_headers["server-timing"] = timer.server_timing()
+            return response
 
-        input_tensor = preprocess(input_image)
-        input_batch = input_tensor.unsqueeze(0)
-        output = self.model(input_batch)
-        torch.nn.functional.softmax(output, dim=1)
-        values, top_5 = torch.topk(output, 5)
-        return {"predictions": values.tolist()}
+    async def profile(self, max_requests: int, max_seconds: float):
+        return await self.pipeline.profiler.capture(max_requests, max_seconds)
 
 
-parser = argparse.ArgumentParser(parents=[model_server.parser])
+parser = argparse.ArgumentParser(parents=[model_server.parser, pipeline_parser()])
 args, _ = parser.parse_known_args()
 
 if __name__ == "__main__":
     # Configure kserve and uvicorn logger
     if args.configure_logging:
         logging.configure_logging(args.log_config_file)
-    app = AlexNetModel.bind(name=args.model_name)
+    app = AlexNetModel.bind(
+        name=args.model_name,
+        **pipeline_options(args),
+    )
     handle = serve.run(app)
     model = RayModel(name=args.model_name, handle=handle)
     model.load()
+    if args.profiler_token_file:
+        # Captures run in a replica, with several replicas in the one the
+        # handle picks.
+        with open(args.profiler_token_file) as token_file:
+            token = token_file.read().strip()
+        model_server.app.include_router(profiler_router(
+            args.model_name,
+            lambda requests, seconds: handle.profile.remote(requests, seconds),
+            token,
+        ))
     ModelServer().start([model])
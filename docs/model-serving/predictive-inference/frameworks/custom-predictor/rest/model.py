@@ -1,78 +1,146 @@
 import argparse
 import base64
-import io
 import time
 
 from fastapi.middleware.cors import CORSMiddleware
-from torchvision import models, transforms
-from typing import Dict
+from torchvision import models
+from typing import Dict, Union
 import torch
-from PIL import Image
 
 import kserve
 from kserve import Model, ModelServer, logging
+from kserve.errors import InvalidInput, ModelNotReady
 from kserve.model_server import app
 from kserve.utils.utils import generate_uuid
 
+from serving_utils import (
+    InferencePipeline,
+    OctetStreamMiddleware,
+    pipeline_options,
+    pipeline_parser,
+    worker_parser,
+    profiler_router,
+    read_binary_images,
+)
+
 
 class AlexNetModel(Model):
-    def __init__(self, name: str):
+    def __init__(self, name: str, background_load: bool = False, **options):
         super().__init__(name, return_response_headers=True)
-        self.load()
+        # The pipeline loads the model and runs its forward passes on an
+        # executor, the event loop keeps serving health probes and parsing
+        # requests in the meantime. Batching, caching and load shedding are
+        # opt-in features of the pipeline, all off with the default options.
+        self.pipeline = InferencePipeline(name, models.alexnet, **options)
         self.ready = False
+        # With background_load the model server binds its ports right away and
+        # start_engine() loads and warms up the model in the background,
+        # healthy() only reports the model ready once the warm-up succeeded.
+        self.engine = background_load
+        self.warm = not background_load
 
     def load(self):
-        self.model = models.alexnet(pretrained=True)
-        self.model.eval()
+        # load() is idempotent, the model server may call it again on a model
+        # that is already loaded, or while start_engine() loads it in the
+        # background, which is the case while the model is not warm.
+        if self.pipeline.model is not None or not self.warm:
+            return
+        self.pipeline.load()
         # The ready flag is used by model ready endpoint for readiness probes,
         # set to True when model is loaded successfully without exceptions.
         self.ready = True
 
+    async def start_engine(self):
+        await self.pipeline.load_in_background()
+        self.warm = True
+
+    async def healthy(self) -> bool:
+        return self.ready and self.warm
+
     async def predict(
         self,
-        payload: Dict,
+        payload: Union[Dict, bytes],
         headers: Dict[str, str] = None,
         response_headers: Dict[str, str] = None,
     ) -> Dict:
-        start = time.time()
-        # Input follows the Tensorflow V1 HTTP API for binary values
-        # https://www.tensorflow.org/tfx/serving/api_rest#encoding_binary_values
-        img_data = payload["instances"][0]["image"]["b64"]
-        raw_img_data = base64.b64decode(img_data)
-        input_image = Image.open(io.BytesIO(raw_img_data))
-        preprocess = transforms.Compose([
-            transforms.Resize(256),
-            transforms.CenterCrop(224),
-            transforms.ToTensor(),
-            transforms.Normalize(mean=[0.485, 0.456, 0.406],
-                                 std=[0.229, 0.224, 0.225]),
-        ])
-        input_tensor = preprocess(input_image).unsqueeze(0)
-        output = self.model(input_tensor)
-        torch.nn.functional.softmax(output, dim=1)
-        values, top_5 = torch.topk(output, 5)
-        result = values.flatten().tolist()
-        end = time.time()
-        response_id = generate_uuid()
+        # With background_load the model server accepts requests while the
+        # model is still loading, they are answered with 503 or UNAVAILABLE.
+        if not await self.healthy():
+            raise ModelNotReady(self.name)
+        with self.pipeline.request(headers) as timer:
+            if isinstance(payload, bytes):
+                # Requests with a non JSON content type, e.g. application/octet-stream,
+                # image/jpeg or multipart/form-data, carry the encoded images as is.
+                content_type = (headers or {}).get("content-type", "application/octet-stream")
+                raw_images = read_binary_images(payload, content_type)
+            else:
+                # Input follows the Tensorflow V1 HTTP API for binary values
+                # https://www.tensorflow.org/tfx/serving/api_rest#encoding_binary_values
+                with timer.stage("b64_decode"):
+                    raw_images = [
+                        base64.b64decode(instance["image"]["b64"])
+                        for instance in payload["instances"]
+                    ]
+            if not raw_images:
+                raise InvalidInput("Expected at least one image")
+            output = await self.pipeline.infer_images(raw_images, timer)
+            with timer.stage("postprocess"):
+                torch.nn.functional.softmax(output, dim=1)
+                values, top_5 = torch.topk(output, 5)
+                result = values.tolist()
+            with timer.stage("response"):
+                response_id = generate_uuid()
+                response = {"predictions": result}
 
-        # Custom response headers can be added to the inference response
-        if response_headers is not None:
-            response_headers.update(
-                {"prediction-time-latency": f"{round((end - start) * 1000, 9)}"}
-            )
+            # Custom response headers can be added to the inference response
+            if response_headers is not None:
+                response_headers.update({
+                    "prediction-time-latency": f"{round((time.perf_counter() - timer.start) * 1000, 9)}",
+                    "server-timing": timer.server_timing(),
+                })
 
-        return {"predictions": result}
+            return response
 
 
-parser = argparse.ArgumentParser(parents=[kserve.model_server.parser])
+parser = argparse.ArgumentParser(
+    parents=[kserve.model_server.parser, pipeline_parser(), worker_parser()]
+)
+parser.add_argument(
+    "--max_batch_size",
+    default=1,
+    type=int,
+    help="The max number of requests grouped into one forward pass. "
+    "Dynamic batching is disabled when set to 1.",
+)
+parser.add_argument(
+    "--max_batch_latency_ms",
+    default=5.0,
+    type=float,
+    help="The max time in milliseconds a request waits for a batch to fill up.",
+)
 args, _ = parser.parse_known_args()
 
 if __name__ == "__main__":
     # Configure kserve and uvicorn logger
     if args.configure_logging:
         logging.configure_logging(args.log_config_file)
-    model = AlexNetModel(args.model_name)
-    model.load()
+    if args.background_load and args.workers > 1:
+        # The worker processes load the model before they bind the port.
+        parser.error("--background_load is not supported with --workers greater than 1")
+    model = AlexNetModel(
+        args.model_name,
+        max_batch_size=args.max_batch_size,
+        max_batch_latency_ms=args.max_batch_latency_ms,
+        processes=args.workers,
+        background_load=args.background_load,
+        share_weights=args.share_weights,
+        **pipeline_options(args),
+    )
+    if args.background_load:
+        # Registers the model with the model server, it is loaded by start_engine()
+        model.ready = True
+    else:
+        model.load()
     # Custom middlewares can be added to the model
     app.add_middleware(
         CORSMiddleware,
@@ -81,4 +149,10 @@ if __name__ == "__main__":
         allow_methods=["*"],
         allow_headers=["*"],
     )
+    # Lets raw application/octet-stream image bodies through to predict
+    app.add_middleware(OctetStreamMiddleware)
+    if args.profiler_token_file:
+        with open(args.profiler_token_file) as token_file:
+            token = token_file.read().strip()
+        app.include_router(profiler_router(args.model_name, model.pipeline.profiler.capture, token))
     ModelServer().start([model])
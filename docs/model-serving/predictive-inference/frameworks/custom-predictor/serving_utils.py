@@ -0,0 +1,1896 @@
+# Serving helpers shared by the rest, grpc and ray custom predictor examples.
+# The model server image is built from a single example directory, copy this
+# module into it before building the image.
+import argparse
+import asyncio
+import atexit
+import contextvars
+import gzip
+import hashlib
+import hmac
+import io
+import math
+import os
+import tempfile
+import time
+import warnings
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager, contextmanager
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import (
+    Any, AsyncIterator, Awaitable, Callable, Deque, Dict, Iterator, List, Optional, Sequence, Set, Tuple, Union,
+)
+
+import grpc
+import numpy as np
+import torch
+from fastapi import APIRouter, HTTPException, Request, Response
+from grpc_interceptor.exceptions import GrpcException
+from PIL import Image, UnidentifiedImageError
+from prometheus_client import Counter, Histogram
+from torchvision import io as tvio
+from torchvision import transforms
+from torchvision.transforms import functional as F
+
+from kserve import InferInput, InferOutput, InferRequest, InferResponse
+from kserve.errors import InvalidInput
+from kserve.logging import logger
+from kserve.protocol.grpc import grpc_predict_v2_pb2_grpc
+from kserve.protocol.grpc.grpc_predict_v2_pb2 import ModelInferRequest, ModelInferResponse
+from kserve.protocol.grpc.interceptors import ExceptionToStatusInterceptor, LoggingInterceptor
+from kserve.protocol.grpc.server import GRPCServer
+from kserve.protocol.grpc.servicer import InferenceServicer
+from kserve.utils.utils import cpu_count, generate_uuid
+
+EXECUTOR_MODES = ["inline", "thread", "process"]
+EXECUTION_MODES = ["eager", "script", "compile"]
+IMAGE_DECODERS = ["pil", "pil-draft", "torchvision"]
+BINARY_CONTENT_TYPES = ["application/octet-stream", "application/x-octet-stream"]
+# The priority classes of requests, most urgent first, set with the
+# PRIORITY_HEADER header or gRPC metadata key.
+PRIORITIES = ["interactive", "bulk"]
+PRIORITY_HEADER = "x-request-priority"
+# The bidirectional streaming RPC served next to the unary ModelInfer RPC.
+STREAM_SERVICE = "inference.GRPCInferenceService"
+STREAM_METHOD = "ModelStreamInfer"
+GRPC_COMPRESSION = {
+    "none": grpc.Compression.NoCompression,
+    "gzip": grpc.Compression.Gzip,
+    "deflate": grpc.Compression.Deflate,
+}
+
+RESPONSE_CACHE_REQUESTS = Counter(
+    "response_cache_requests",
+    "response cache lookups by result (hit, miss or coalesced)",
+    ["model_name", "result"],
+)
+# Finer than the prometheus defaults, decoding a small image takes about a millisecond.
+STAGE_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)
+REQUEST_STAGE_SECONDS = Histogram(
+    "request_stage_seconds",
+    "predict request latency by stage",
+    ["model_name", "stage"],
+    buckets=STAGE_BUCKETS,
+)
+REQUEST_PRIORITY_SECONDS = Histogram(
+    "request_priority_seconds",
+    "predict request latency by priority class",
+    ["model_name", "priority"],
+    buckets=STAGE_BUCKETS,
+)
+SHED_REQUESTS = Counter(
+    "shed_requests",
+    "requests dropped before inference by reason (expired or overloaded)",
+    ["model_name", "reason"],
+)
+# REST clients send their timeout in milliseconds in the first of these
+# headers, Envoy based ingresses set the second one to the route timeout.
+TIMEOUT_HEADERS = ["x-request-timeout-ms", "x-envoy-expected-rq-timeout-ms"]
+# The deadline of the request being served, as a time.monotonic() value.
+REQUEST_DEADLINE: contextvars.ContextVar[Optional[float]] = contextvars.ContextVar(
+    "request_deadline", default=None
+)
+# The priority class of the request being served.
+REQUEST_PRIORITY: contextvars.ContextVar[str] = contextvars.ContextVar(
+    "request_priority", default=PRIORITIES[0]
+)
+
+# torchvision decodes straight from the request bytes, which it never writes to.
+warnings.filterwarnings("ignore", message="The given buffer is not writable")
+
+
+class OctetStreamMiddleware:
+    """ASGI middleware that lets application/octet-stream bodies reach predict.
+
+    The KServe data plane parses application/octet-stream request bodies as
+    JSON, this middleware renames their content type to
+    ``application/x-octet-stream`` which is passed through as bytes.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http":
+            headers = scope["headers"]
+            for i, (name, value) in enumerate(headers):
+                if name == b"content-type" and value.lower().startswith(b"application/octet-stream"):
+                    headers = list(headers)
+                    headers[i] = (name, b"application/x-octet-stream")
+                    scope = dict(scope, headers=headers)
+                    break
+        await self.app(scope, receive, send)
+
+
+def load_mmap_weights(
+    build: Callable[[], torch.nn.Module], model_path: str
+) -> torch.nn.Module:
+    """Build a module and assign it the weights of a state_dict saved with
+    torch.save at model_path. The module is built on the meta device, so its
+    weights are neither allocated nor randomly initialized, and the file is
+    memory-mapped, so its pages are only read from disk when they are used."""
+    with torch.device("meta"):
+        model = build()
+    state_dict = torch.load(model_path, mmap=True, weights_only=True, map_location="cpu")
+    model.load_state_dict(state_dict, assign=True)
+    return model
+
+
+def export_weights(model: torch.nn.Module) -> str:
+    """Save the weights of model to a temporary file, which is removed when the
+    process exits, and return its path for load_mmap_weights. Processes that
+    memory-map the file share its pages in the page cache."""
+    fd, path = tempfile.mkstemp(prefix="alexnet-", suffix=".pt")
+    with os.fdopen(fd, "wb") as weights_file:
+        torch.save(model.state_dict(), weights_file)
+    atexit.register(os.remove, path)
+    return path
+
+
+def artifact_key(model_path: Optional[str], *options) -> str:
+    """Identify the weights and options a compiled artifact is built from. A
+    weights file is identified by its path, size and modification time."""
+    parts = [torch.__version__, model_path or "pretrained", *options]
+    if model_path:
+        stat = os.stat(model_path)
+        parts += [stat.st_size, stat.st_mtime_ns]
+    return hashlib.blake2b(repr(parts).encode(), digest_size=8).hexdigest()
+
+
+def optimize_model(
+    model: torch.nn.Module,
+    execution_mode: str = "eager",
+    cache_dir: Optional[str] = None,
+    cache_key: str = "",
+) -> torch.nn.Module:
+    """Return the model to run forward passes with in the given execution mode.
+
+    - ``eager`` returns the model as is.
+    - ``script`` scripts and freezes the model with TorchScript. The frozen
+      model is saved to ``cache_dir`` and loaded from there on later starts.
+    - ``compile`` compiles the model with ``torch.compile``, which happens
+      lazily on the first forward pass of each input shape. The compiled
+      kernels are cached in ``cache_dir`` and reused on later starts.
+    """
+    if execution_mode not in EXECUTION_MODES:
+        raise ValueError(f"Unknown execution mode {execution_mode}, expected one of {EXECUTION_MODES}")
+    if execution_mode == "script":
+        path = None
+        if cache_dir:
+            path = os.path.join(cache_dir, f"alexnet-scripted-{cache_key}.pt")
+        if path and os.path.exists(path):
+            scripted = torch.jit.load(path, map_location="cpu")
+        else:
+            scripted = torch.jit.freeze(torch.jit.script(model))
+            if path:
+                os.makedirs(cache_dir, exist_ok=True)
+                # Write to a temporary file first, workers starting concurrently
+                # must never load a partially written artifact.
+                tmp_path = f"{path}.{os.getpid()}.tmp"
+                torch.jit.save(scripted, tmp_path)
+                os.replace(tmp_path, path)
+        # Modules optimized for inference can not be saved, optimize after loading.
+        return torch.jit.optimize_for_inference(scripted)
+    if execution_mode == "compile":
+        if cache_dir:
+            from torch._inductor import config as inductor_config
+
+            os.environ["TORCHINDUCTOR_CACHE_DIR"] = os.path.join(cache_dir, "inductor")
+            inductor_config.fx_graph_cache = True
+        return torch.compile(model)
+    return model
+
+
+def quantize_dynamic_int8(model: torch.nn.Module) -> torch.nn.Module:
+    """Quantize the weights of the Linear layers to int8, their activations are
+    quantized on the fly. The classifier Linear layers hold about 96% of the
+    AlexNet parameters, so this cuts the model memory by almost 4x."""
+    return torch.ao.quantization.quantize_dynamic(
+        model, {torch.nn.Linear}, dtype=torch.qint8
+    )
+
+
+def cpu_limit() -> int:
+    """Return the number of CPUs the container may use. Extends the KServe
+    cpu_count, which reads the cgroup v1 CPU quota, with the cgroup v2 one."""
+    count = cpu_count()
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as cpu_max:
+            quota, period = cpu_max.read().split()
+        if quota != "max":
+            count = min(count, max(1, int(int(quota) / int(period))))
+    except (OSError, ValueError):
+        pass
+    return count
+
+
+def thread_budget(processes: int = 1, concurrent_forwards: int = 1, cpus: Optional[int] = None) -> int:
+    """Split the CPUs of the container, or the given number of CPUs, between
+    the forward passes that run concurrently in all model server processes,
+    so that their intra-op threads do not oversubscribe the CPUs."""
+    return max(1, (cpus or cpu_limit()) // (processes * concurrent_forwards))
+
+
+def replica_cpus() -> int:
+    """Return the CPUs Ray assigned to the Ray Serve replica, set with
+    ray_actor_options num_cpus on the deployment, or the CPU limit of the
+    container when not running in a Ray worker, e.g. in the benchmarks."""
+    import ray
+
+    try:
+        cpus = ray.get_runtime_context().get_assigned_resources().get("CPU", 1)
+    except AssertionError:
+        return cpu_limit()
+    return max(1, int(cpus))
+
+
+class RayMetrics:
+    """Records the latency metrics and the shed requests of a Ray Serve
+    replica with the Ray metrics API. Replicas run in Ray worker processes,
+    their metrics are exported by the Ray metrics agent of the node rather
+    than on the /metrics endpoint of the model server."""
+
+    def __init__(self, model_name: str):
+        from ray.util import metrics
+
+        self.model_name = model_name
+        self.stage_seconds = metrics.Histogram(
+            "request_stage_seconds",
+            description="predict request latency by stage",
+            boundaries=list(STAGE_BUCKETS),
+            tag_keys=("model_name", "stage"),
+        )
+        self.priority_seconds = metrics.Histogram(
+            "request_priority_seconds",
+            description="predict request latency by priority class",
+            boundaries=list(STAGE_BUCKETS),
+            tag_keys=("model_name", "priority"),
+        )
+        self.shed_requests = metrics.Counter(
+            "shed_requests",
+            description="requests dropped before inference by reason (expired or overloaded)",
+            tag_keys=("model_name", "reason"),
+        )
+
+    def observe(self, timer: "StageTimer", priority: Optional[str] = None):
+        for stage, seconds in timer.durations.items():
+            self.stage_seconds.observe(seconds, tags={"model_name": self.model_name, "stage": stage})
+        if priority is not None:
+            self.priority_seconds.observe(
+                time.perf_counter() - timer.start,
+                tags={"model_name": self.model_name, "priority": priority},
+            )
+
+    def shed(self, reason: str):
+        self.shed_requests.inc(tags={"model_name": self.model_name, "reason": reason})
+
+
+def set_torch_threads(intra_op_threads: int, inter_op_threads: int = 0):
+    """Set the torch intra-op and inter-op thread pool sizes of this process,
+    0 keeps the torch default."""
+    if intra_op_threads > 0:
+        torch.set_num_threads(intra_op_threads)
+    if inter_op_threads > 0 and torch.get_num_interop_threads() != inter_op_threads:
+        try:
+            torch.set_num_interop_threads(inter_op_threads)
+        except RuntimeError:
+            # The inter-op pool can only be sized before it is first used.
+            logger.warning("Inter-op threads are already set to %s", torch.get_num_interop_threads())
+
+
+def sweep_threads(
+    forward: Callable[[torch.Tensor], torch.Tensor],
+    batch: torch.Tensor,
+    max_threads: int,
+    iterations: int = 5,
+) -> int:
+    """Time forward passes with 1, 2, 4, ... up to max_threads intra-op
+    threads and return the thread count to use: the smallest one within 5% of
+    the fastest, the spare CPUs are left to image decoding."""
+    candidates = sorted({2**i for i in range(max_threads.bit_length())} | {max_threads})
+    timings = {}
+    for threads in candidates:
+        torch.set_num_threads(threads)
+        forward(batch)
+        start = time.perf_counter()
+        for _ in range(iterations):
+            forward(batch)
+        timings[threads] = (time.perf_counter() - start) / iterations * 1000
+    fastest = min(timings.values())
+    best = min(threads for threads, ms in timings.items() if ms <= fastest * 1.05)
+    logger.info(
+        "Intra-op thread sweep for batch size %s: %s, using %s threads",
+        batch.shape[0],
+        ", ".join(f"{threads}: {ms:.1f}ms" for threads, ms in timings.items()),
+        best,
+    )
+    torch.set_num_threads(best)
+    return best
+
+
+def warm_up_image(size: int = 256) -> bytes:
+    """Encode a gray JPEG image to warm up the model before it reports ready."""
+    buffer = io.BytesIO()
+    Image.new("RGB", (size, size), (128, 128, 128)).save(buffer, format="JPEG")
+    return buffer.getvalue()
+
+
+def fp32_tensor(infer_input: InferInput, shape: Sequence[int] = (3, 224, 224)) -> torch.Tensor:
+    """Return an FP32 input of shape [N, *shape] as a tensor. Inputs sent as
+    raw_input_contents are viewed in place, without copying them."""
+    if infer_input.datatype != "FP32":
+        raise InvalidInput(f"Expected an FP32 input, got {infer_input.datatype}")
+    try:
+        array = infer_input.as_numpy()
+    except ValueError as e:
+        raise InvalidInput(f"Invalid FP32 input of shape {infer_input.shape}: {e}")
+    if array.dtype != np.float32 or array.ndim != len(shape) + 1 or array.shape[1:] != tuple(shape):
+        raise InvalidInput(
+            f"Expected an FP32 input of shape [N, {', '.join(map(str, shape))}], "
+            f"got {array.dtype} of shape {list(array.shape)}"
+        )
+    # The model never writes to its input, the read-only request buffer is
+    # viewed as is.
+    with warnings.catch_warnings():
+        warnings.filterwarnings("ignore", message="The given NumPy array is not writable")
+        return torch.from_numpy(array)
+
+
+def bytes_input(infer_input: InferInput) -> List[bytes]:
+    """Return the elements of a BYTES input of shape [N], sent as bytes_contents
+    or as raw_input_contents."""
+    if infer_input.data:
+        elements = list(infer_input.data)
+    else:
+        elements = list(infer_input.as_numpy().reshape(-1))
+    if not elements:
+        raise InvalidInput("Expected at least one image")
+    if len(elements) != math.prod(infer_input.shape):
+        raise InvalidInput(
+            f"Expected {math.prod(infer_input.shape)} elements for shape {infer_input.shape}, "
+            f"got {len(elements)}"
+        )
+    return elements
+
+
+def fp32_response(payload: InferRequest, output: torch.Tensor, model_name: str) -> InferResponse:
+    """Build the response of an FP32 output. gRPC responses carry it as
+    raw_output_contents bytes instead of repeated fp32_contents values, REST
+    clients opt in with the binary_data_output parameter."""
+    infer_output = InferOutput(name="output-0", shape=list(output.shape), datatype="FP32")
+    infer_output.set_data_from_numpy(
+        output.numpy(), binary_data=payload.from_grpc or payload.use_binary_outputs
+    )
+    return InferResponse(
+        response_id=payload.id or generate_uuid(),
+        model_name=model_name,
+        infer_outputs=[infer_output],
+        use_binary_outputs=payload.use_binary_outputs,
+        requested_outputs=payload.request_outputs,
+    )
+
+
+def read_binary_images(body: bytes, content_type: str) -> List[bytes]:
+    """Return the encoded images of a binary request body.
+
+    ``application/octet-stream`` and ``image/*`` bodies are a single image and
+    are returned as is. ``multipart/form-data`` bodies return the content of
+    every file part, in order.
+    """
+    media_type, _, params = content_type.partition(";")
+    media_type = media_type.strip().lower()
+    if media_type in BINARY_CONTENT_TYPES or media_type.startswith("image/"):
+        return [body]
+    if media_type == "multipart/form-data":
+        for param in params.split(";"):
+            name, _, value = param.strip().partition("=")
+            if name.lower() == "boundary" and value:
+                return split_multipart(body, value.strip('"').encode())
+        raise InvalidInput("Missing boundary in multipart content type")
+    raise InvalidInput(f"Unsupported content type {media_type}")
+
+
+def split_multipart(body: bytes, boundary: bytes) -> List[bytes]:
+    """Return the content of the file parts of a multipart/form-data body.
+
+    Parts are located with bytes.find, so each file is copied out of the body
+    exactly once.
+    """
+    delimiter = b"--" + boundary
+    files = []
+    start = body.find(delimiter)
+    while start != -1:
+        start += len(delimiter)
+        # The closing delimiter is followed by "--".
+        if body.startswith(b"--", start):
+            break
+        headers_end = body.find(b"\r\n\r\n", start)
+        end = body.find(b"\r\n" + delimiter, headers_end)
+        if headers_end == -1 or end == -1:
+            raise InvalidInput("Malformed multipart body")
+        if b"filename=" in body[start:headers_end]:
+            files.append(body[headers_end + 4:end])
+        start = end + 2
+    return files
+
+
+class RequestShed(Exception):
+    """A request dropped before inference, answered with http_status to REST
+    and grpc_status to gRPC clients."""
+
+    reason = "shed"
+    http_status = 503
+    grpc_status = grpc.StatusCode.UNAVAILABLE
+
+
+class DeadlineExpired(RequestShed):
+    reason = "expired"
+    http_status = 504
+    grpc_status = grpc.StatusCode.DEADLINE_EXCEEDED
+
+
+class Overloaded(RequestShed):
+    reason = "overloaded"
+    http_status = 429
+    grpc_status = grpc.StatusCode.RESOURCE_EXHAUSTED
+
+
+def request_deadline(headers: Optional[Dict[str, str]]) -> Optional[float]:
+    """Return the deadline of a request, set from the gRPC deadline by the
+    gRPC server or read from the timeout headers of a REST request."""
+    deadline = REQUEST_DEADLINE.get()
+    if deadline is not None or not headers:
+        return deadline
+    for header in TIMEOUT_HEADERS:
+        if header in headers:
+            try:
+                return time.monotonic() + float(headers[header]) / 1000
+            except ValueError:
+                raise InvalidInput(f"Invalid {header} header {headers[header]!r}")
+    return None
+
+
+def request_priority(headers: Optional[Dict[str, str]]) -> str:
+    """Return the priority class of a request, interactive unless the
+    x-request-priority header or metadata says otherwise."""
+    priority = (headers or {}).get(PRIORITY_HEADER, PRIORITIES[0]).lower()
+    if priority not in PRIORITIES:
+        raise InvalidInput(f"Invalid {PRIORITY_HEADER} {priority!r}, expected one of {PRIORITIES}")
+    return priority
+
+
+def check_deadline(deadline: Optional[float]):
+    if deadline is not None and time.monotonic() >= deadline:
+        raise DeadlineExpired("The request deadline passed before inference")
+
+
+def _timed_call(deadline: Optional[float], fn: Callable, *args) -> Tuple[Any, float]:
+    """Run fn unless the deadline passed and return its result and seconds."""
+    check_deadline(deadline)
+    start = time.perf_counter()
+    return fn(*args), time.perf_counter() - start
+
+
+class DeadlineServicer(InferenceServicer):
+    """Passes the deadline of ModelInfer calls on to predict, the gRPC
+    runtime does not include it in the request metadata."""
+
+    async def ModelInfer(self, request: ModelInferRequest, context) -> ModelInferResponse:
+        remaining = context.time_remaining()
+        token = REQUEST_DEADLINE.set(None if remaining is None else time.monotonic() + remaining)
+        try:
+            return await super().ModelInfer(request, context)
+        finally:
+            REQUEST_DEADLINE.reset(token)
+
+
+class LoadShedder:
+    """Drops requests whose deadline passed and rejects new requests while the
+    estimated queue delay exceeds max_queue_delay_ms.
+
+    The queue delay is estimated as the work of the requests in flight spread
+    over the concurrent forward passes of the executor. Only requests of the
+    same or a more urgent priority class count, the executor runs the work of
+    more urgent requests first. The work per request
+    is the moving average of the seconds the executor spent decoding and
+    running forward passes between two completed requests, so that it follows
+    the load without counting the time requests waited. Within ``admit`` the
+    deadline is checked again before every decode and forward pass of the
+    executor. Shed requests are counted in the shed_requests counter, or
+    passed to on_shed with their reason, and raised as HTTPException, or as
+    GrpcException for gRPC requests.
+    """
+
+    def __init__(self, model_name: str, executor: "InferenceExecutor", max_queue_delay_ms: float = 0,
+                 smoothing: float = 0.1, on_shed: Optional[Callable[[str], None]] = None):
+        self.model_name = model_name
+        self.executor = executor
+        self.max_queue_delay = max_queue_delay_ms / 1000
+        self.smoothing = smoothing
+        self.on_shed = on_shed
+        self.pending = dict.fromkeys(PRIORITIES, 0)
+        self.service_time = 0.0
+        self._busy = 0.0
+
+    def queue_delay(self, priority: str = PRIORITIES[-1]) -> float:
+        """The estimated seconds until the requests in flight of the priority
+        class and the more urgent ones completed."""
+        ahead = sum(self.pending[p] for p in PRIORITIES[:PRIORITIES.index(priority) + 1])
+        return ahead * self.service_time / self.executor.concurrency
+
+    def error(self, shed: RequestShed, from_grpc: bool) -> Exception:
+        if self.on_shed is None:
+            SHED_REQUESTS.labels(self.model_name, shed.reason).inc()
+        else:
+            self.on_shed(shed.reason)
+        if from_grpc:
+            return GrpcException(str(shed), shed.grpc_status)
+        return HTTPException(shed.http_status, str(shed))
+
+    @contextmanager
+    def admit(self, deadline: Optional[float], from_grpc: bool = False,
+              priority: str = PRIORITIES[0]) -> Iterator[None]:
+        try:
+            check_deadline(deadline)
+            queue_delay = self.queue_delay(priority)
+            if self.max_queue_delay and queue_delay > self.max_queue_delay:
+                raise Overloaded(
+                    f"The estimated queue delay of {queue_delay * 1000:.0f} ms exceeds "
+                    f"{self.max_queue_delay * 1000:.0f} ms"
+                )
+        except RequestShed as e:
+            raise self.error(e, from_grpc) from e
+        self.pending[priority] += 1
+        deadline_token = REQUEST_DEADLINE.set(deadline)
+        priority_token = REQUEST_PRIORITY.set(priority)
+        try:
+            yield
+        except RequestShed as e:
+            raise self.error(e, from_grpc) from e
+        finally:
+            self.pending[priority] -= 1
+            REQUEST_DEADLINE.reset(deadline_token)
+            REQUEST_PRIORITY.reset(priority_token)
+            busy = self.executor.busy_seconds
+            self.service_time += self.smoothing * (busy - self._busy - self.service_time)
+            self._busy = busy
+
+
+class StageTimer:
+    """Accumulates the time spent in each stage of a request.
+
+    Durations are measured with ``time.perf_counter``, a monotonic clock. A
+    stage that runs for several images of a request, e.g. image_decode, adds
+    up the time of every image.
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.durations: Dict[str, float] = {}
+
+    def add(self, stage: str, seconds: float):
+        self.durations[stage] = self.durations.get(stage, 0.0) + seconds
+
+    @contextmanager
+    def stage(self, stage: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - start)
+
+    def server_timing(self) -> str:
+        """Format the durations as a Server-Timing header value in milliseconds,
+        followed by the total time since the timer was created."""
+        durations = list(self.durations.items())
+        durations.append(("total", time.perf_counter() - self.start))
+        return ", ".join(f"{stage};dur={seconds * 1000:.3f}" for stage, seconds in durations)
+
+    def observe(self, model_name: str, priority: Optional[str] = None):
+        """Record the durations in the request_stage_seconds histogram and, for
+        a request of a priority class, the time since the timer was created in
+        the request_priority_seconds histogram."""
+        for stage, seconds in self.durations.items():
+            REQUEST_STAGE_SECONDS.labels(model_name, stage).observe(seconds)
+        if priority is not None:
+            REQUEST_PRIORITY_SECONDS.labels(model_name, priority).observe(
+                time.perf_counter() - self.start
+            )
+
+
+class ImagePreprocessor:
+    """Turns an encoded image into a normalized [3, crop, crop] float tensor.
+
+    The transforms are built once. Resizing and cropping run on the uint8
+    image, and ToTensor followed by Normalize is fused into a single
+    ``x * scale + offset`` with precomputed per-channel scale and offset.
+
+    Images are validated from their header before decoding, images larger
+    than ``max_image_pixels`` and truncated JPEG files are rejected without
+    paying for a full decode. The ``decoder`` selects how images are decoded:
+
+    - ``pil`` decodes at full resolution with PIL.
+    - ``pil-draft`` lets libjpeg scale JPEG images by 1/2, 1/4 or 1/8 while
+      decoding (DCT scaling), so that the short side is still at least
+      ``resize`` pixels. Large photos are never decoded at full resolution.
+    - ``torchvision`` decodes with ``torchvision.io.decode_image`` into a
+      uint8 tensor and resizes the tensor.
+    """
+
+    def __init__(
+        self,
+        resize: int = 256,
+        crop: int = 224,
+        mean: Sequence[float] = (0.485, 0.456, 0.406),
+        std: Sequence[float] = (0.229, 0.224, 0.225),
+        decoder: str = "pil",
+        max_image_pixels: int = 64_000_000,
+    ):
+        if decoder not in IMAGE_DECODERS:
+            raise ValueError(f"Unknown image decoder {decoder}, expected one of {IMAGE_DECODERS}")
+        self.resize = resize
+        self.decoder = decoder
+        self.max_image_pixels = max_image_pixels
+        self.resize_crop = transforms.Compose([
+            transforms.Resize(resize),
+            transforms.CenterCrop(crop),
+        ])
+        mean = torch.tensor(mean).view(-1, 1, 1)
+        std = torch.tensor(std).view(-1, 1, 1)
+        self.scale = 1 / (255 * std)
+        self.offset = -mean / std
+
+    def open(self, raw_img_data: bytes) -> Image.Image:
+        """Parse the image header and reject images that are too large or truncated."""
+        try:
+            input_image = Image.open(io.BytesIO(raw_img_data))
+        except (UnidentifiedImageError, Image.DecompressionBombError) as e:
+            raise InvalidInput(f"Unsupported or corrupted image: {e}")
+        width, height = input_image.size
+        if width * height > self.max_image_pixels:
+            raise InvalidInput(
+                f"Image of {width}x{height} pixels exceeds the limit of {self.max_image_pixels} pixels"
+            )
+        # Every JPEG file ends with an EOI marker, a cut off upload does not. An
+        # EXIF thumbnail has an EOI marker of its own, so only the end counts,
+        # after the zero padding that some encoders append.
+        if input_image.format == "JPEG" and not raw_img_data.rstrip(b"\x00").endswith(b"\xff\xd9"):
+            raise InvalidInput("Truncated JPEG image")
+        return input_image
+
+    def decode(self, raw_img_data: bytes) -> Union[Image.Image, torch.Tensor]:
+        input_image = self.open(raw_img_data)
+        try:
+            if self.decoder == "torchvision":
+                return tvio.decode_image(
+                    torch.frombuffer(raw_img_data, dtype=torch.uint8),
+                    mode=tvio.ImageReadMode.RGB,
+                )
+            if self.decoder == "pil-draft" and input_image.format == "JPEG":
+                width, height = input_image.size
+                ratio = self.resize / min(width, height)
+                input_image.draft(
+                    "RGB", (math.ceil(width * ratio), math.ceil(height * ratio))
+                )
+            return input_image.convert("RGB")
+        except (OSError, RuntimeError) as e:
+            raise InvalidInput(f"Failed to decode image: {e}")
+
+    def transform(self, input_image: Union[Image.Image, torch.Tensor]) -> torch.Tensor:
+        input_tensor = self.resize_crop(input_image)
+        if isinstance(input_tensor, Image.Image):
+            input_tensor = F.pil_to_tensor(input_tensor)
+        return input_tensor.to(torch.float32).mul_(self.scale).add_(self.offset)
+
+    def __call__(self, raw_img_data: bytes) -> torch.Tensor:
+        return self.transform(self.decode(raw_img_data))
+
+    def timed(self, raw_img_data: bytes) -> Tuple[torch.Tensor, float, float]:
+        """Preprocess an image and also return the seconds spent decoding and
+        transforming it, measured where it runs, e.g. in a decode process."""
+        start = time.perf_counter()
+        input_image = self.decode(raw_img_data)
+        decoded = time.perf_counter()
+        input_tensor = self.transform(input_image)
+        return input_tensor, decoded - start, time.perf_counter() - decoded
+
+
+class PrioritySemaphore:
+    """An asyncio semaphore that lets waiters in by priority class, the most
+    urgent class of PRIORITIES first and in arrival order within a class."""
+
+    def __init__(self, value: int):
+        self._value = value
+        self._waiters: Dict[str, Deque[asyncio.Future]] = {priority: deque() for priority in PRIORITIES}
+
+    async def acquire(self, priority: str = PRIORITIES[0]):
+        if self._value > 0 and not any(self._waiters.values()):
+            self._value -= 1
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters[priority].append(waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # Cancelled after the slot was handed over, pass it on.
+                self.release()
+            else:
+                self._waiters[priority].remove(waiter)
+            raise
+
+    def release(self):
+        # The slot goes straight to the next waiter, a new arrival cannot take
+        # it in between.
+        for priority in PRIORITIES:
+            waiters = self._waiters[priority]
+            while waiters:
+                waiter = waiters.popleft()
+                if not waiter.done():
+                    waiter.set_result(None)
+                    return
+        self._value += 1
+
+    @asynccontextmanager
+    async def hold(self, priority: str = PRIORITIES[0]):
+        await self.acquire(priority)
+        try:
+            yield
+        finally:
+            self.release()
+
+
+class InferenceExecutor:
+    """Runs the blocking image decoding and forward passes off the event loop.
+
+    - ``inline`` runs everything on the event loop, as a plain predictor does.
+    - ``thread`` runs decoding and forward passes on a thread pool. Torch and
+      PIL release the GIL for the heavy lifting, so the loop stays responsive.
+    - ``process`` additionally moves decoding to a process pool, forward passes
+      stay on the thread pool so that the model weights are not copied into
+      every worker process.
+
+    ``max_concurrency`` bounds the number of forward passes in flight, further
+    requests wait on the event loop instead of piling up in the pool. Work
+    waits for a free worker of its pool on the event loop as well, so that the
+    work of the most urgent ``REQUEST_PRIORITY`` runs first rather than in the
+    order of the pool's queue. Work of a request whose ``REQUEST_DEADLINE``
+    passed while it waited is dropped with ``DeadlineExpired`` before it runs,
+    the time spent running work adds up in ``busy_seconds``. While ``inline``
+    is set, e.g. during a profiler capture, all work runs on the event loop.
+    """
+
+    def __init__(self, mode: str = "thread", workers: int = 1, max_concurrency: int = 0):
+        if mode not in EXECUTOR_MODES:
+            raise ValueError(f"Unknown executor mode {mode}, expected one of {EXECUTOR_MODES}")
+        self.mode = mode
+        self.workers = workers
+        self.max_concurrency = max_concurrency
+        self._forward_pool: Optional[Executor] = None
+        self._decode_pool: Optional[Executor] = None
+        self._forward_slots: Optional[PrioritySemaphore] = None
+        self._decode_slots: Optional[PrioritySemaphore] = None
+        if mode != "inline":
+            self._forward_pool = ThreadPoolExecutor(workers, thread_name_prefix="inference")
+            self._decode_pool = self._forward_pool
+            self._forward_slots = PrioritySemaphore(workers)
+            self._decode_slots = self._forward_slots
+        if mode == "process":
+            self._decode_pool = ProcessPoolExecutor(workers)
+            self._decode_slots = PrioritySemaphore(workers)
+        self._semaphore = PrioritySemaphore(max_concurrency) if max_concurrency > 0 else None
+        # The seconds spent running decoding and forward passes, for LoadShedder.
+        self.busy_seconds = 0.0
+        self.inline = False
+
+    @property
+    def concurrency(self) -> int:
+        """The number of forward passes that may run at the same time."""
+        if self.mode == "inline":
+            return 1
+        if self.max_concurrency > 0:
+            return min(self.workers, self.max_concurrency)
+        return self.workers
+
+    def __reduce__(self):
+        # The model server pickles the model into each of its --workers
+        # processes, every process starts pools of its own.
+        return InferenceExecutor, (self.mode, self.workers, self.max_concurrency)
+
+    async def _run(self, pool: Optional[Executor], slots: Optional[PrioritySemaphore], fn: Callable, *args):
+        deadline = REQUEST_DEADLINE.get()
+        if pool is None or self.inline:
+            result, seconds = _timed_call(deadline, fn, *args)
+        else:
+            async with slots.hold(REQUEST_PRIORITY.get()):
+                result, seconds = await asyncio.get_running_loop().run_in_executor(
+                    pool, _timed_call, deadline, fn, *args
+                )
+        self.busy_seconds += seconds
+        return result
+
+    async def decode(self, fn: Callable, *args):
+        """Run a decoding function, in process mode fn and args must be picklable."""
+        return await self._run(self._decode_pool, self._decode_slots, fn, *args)
+
+    async def forward(self, fn: Callable, *args):
+        if self._semaphore is None:
+            return await self._run(self._forward_pool, self._forward_slots, fn, *args)
+        async with self._semaphore.hold(REQUEST_PRIORITY.get()):
+            return await self._run(self._forward_pool, self._forward_slots, fn, *args)
+
+    def shutdown(self):
+        for pool in {self._forward_pool, self._decode_pool}:
+            if pool is not None:
+                pool.shutdown(wait=False)
+
+
+class DynamicBatcher:
+    """Collects concurrent inference calls into a single batched forward pass.
+
+    Callers submit a tensor of shape ``[n, ...]`` and get back the matching
+    ``n`` rows of the model output. Pending tensors are concatenated along the
+    first dimension until either ``max_batch_size`` rows are queued or
+    ``max_latency_ms`` has elapsed since the first pending request arrived.
+    The batches run with the given ``priority`` class.
+    """
+
+    def __init__(
+        self,
+        infer: Callable[[torch.Tensor], Awaitable[torch.Tensor]],
+        max_batch_size: int = 8,
+        max_latency_ms: float = 5.0,
+        priority: str = PRIORITIES[0],
+    ):
+        self.infer = infer
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency_ms / 1000
+        self.priority = priority
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+        self._inflight = set()
+
+    async def submit(self, tensor: torch.Tensor) -> torch.Tensor:
+        # The queue and worker are created lazily so that they are bound to the
+        # event loop of the model server rather than the one active at load().
+        if self._worker is None or self._worker.done():
+            self._queue = asyncio.Queue()
+            self._worker = asyncio.create_task(self._run())
+        deadline = REQUEST_DEADLINE.get()
+        check_deadline(deadline)
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((tensor, future, deadline))
+        return await future
+
+    async def _collect(self) -> List[Tuple[torch.Tensor, asyncio.Future, Optional[float]]]:
+        item = await self._queue.get()
+        batch = [item]
+        size = item[0].shape[0]
+        deadline = time.monotonic() + self.max_latency
+        while size < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                item = await asyncio.wait_for(self._queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+            batch.append(item)
+            size += item[0].shape[0]
+        return batch
+
+    async def _run(self):
+        # The worker serves every request, not only the one whose context it
+        # was created in, their deadlines are checked in _infer.
+        REQUEST_DEADLINE.set(None)
+        REQUEST_PRIORITY.set(self.priority)
+        while True:
+            batch = await self._collect()
+            # The next batch is collected while this one is being inferred.
+            task = asyncio.create_task(self._infer(batch))
+            self._inflight.add(task)
+            task.add_done_callback(self._inflight.discard)
+
+    async def _infer(self, batch: List[Tuple[torch.Tensor, asyncio.Future, Optional[float]]]):
+        # Requests whose deadline passed while the batch filled up are dropped.
+        live = []
+        for tensor, future, deadline in batch:
+            try:
+                check_deadline(deadline)
+                live.append((tensor, future))
+            except DeadlineExpired as e:
+                if not future.done():
+                    future.set_exception(e)
+        if not live:
+            return
+        tensors = [tensor for tensor, _ in live]
+        try:
+            outputs = await self.infer(torch.cat(tensors))
+        except Exception as e:
+            for _, future in live:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        sizes = [tensor.shape[0] for tensor in tensors]
+        for (_, future), output in zip(live, outputs.split(sizes)):
+            # The caller may have gone away (e.g. client disconnect).
+            if not future.done():
+                future.set_result(output)
+
+
+class PriorityBatchers:
+    """Runs forward passes through the DynamicBatcher of the priority class of
+    the request, or right away for the classes without one."""
+
+    def __init__(self, infer: Callable[[torch.Tensor], Awaitable[torch.Tensor]]):
+        self.infer = infer
+        self.batchers: Dict[str, DynamicBatcher] = {}
+
+    def add(self, priority: str, max_batch_size: int, max_latency_ms: float):
+        self.batchers[priority] = DynamicBatcher(self.infer, max_batch_size, max_latency_ms, priority)
+
+    async def submit(self, tensor: torch.Tensor) -> torch.Tensor:
+        batcher = self.batchers.get(REQUEST_PRIORITY.get())
+        if batcher is None:
+            return await self.infer(tensor)
+        return await batcher.submit(tensor)
+
+
+async def batches_on_arrival(
+    messages: AsyncIterator, max_batch_size: int, max_pending: int
+) -> AsyncIterator[List]:
+    """Yield the messages of a stream in batches, in order.
+
+    Messages are read ahead while a batch is being processed, the next batch
+    holds whatever arrived in the meantime, up to ``max_batch_size`` messages.
+    Reading pauses while ``max_pending`` messages are waiting, which leaves the
+    transport's flow control to slow down the sender.
+    """
+    queue = asyncio.Queue(max_pending)
+    end = object()
+
+    async def read():
+        try:
+            async for message in messages:
+                await queue.put(message)
+        finally:
+            await queue.put(end)
+
+    reader = asyncio.create_task(read())
+    try:
+        finished = False
+        while not finished:
+            batch = [await queue.get()]
+            while len(batch) < max_batch_size and not queue.empty():
+                batch.append(queue.get_nowait())
+            # The end marker is the last message put, so it ends a batch.
+            finished = batch[-1] is end
+            if finished:
+                batch.pop()
+            if batch:
+                yield batch
+        # Raises the error the stream ended with, if any.
+        await reader
+    finally:
+        reader.cancel()
+
+
+class ResponseCache:
+    """Content addressed LRU cache of model outputs for encoded images.
+
+    Entries are keyed on a hash of the image bytes, so repeated images skip
+    decoding, preprocessing and the forward pass. The cache holds at most
+    ``max_bytes`` of outputs, evicting the least recently used entries, and
+    entries expire after ``ttl_seconds`` unless it is 0. Concurrent requests
+    for an image that is already being inferred wait for that result instead
+    of running another forward pass, which completes even when the request
+    that started it is cancelled. The shared forward pass runs without a
+    deadline, in the most urgent priority class, every request waits for it
+    until its own ``REQUEST_DEADLINE`` at most.
+    """
+
+    # Rough per entry bookkeeping cost on top of the output tensor.
+    ENTRY_OVERHEAD = 256
+
+    def __init__(self, model_name: str, max_bytes: int, ttl_seconds: float = 0):
+        self.model_name = model_name
+        self.max_bytes = max_bytes
+        self.ttl = ttl_seconds
+        self.size_bytes = 0
+        self.evictions = 0
+        self.counts = {"hit": 0, "miss": 0, "coalesced": 0}
+        self._entries: "OrderedDict[bytes, Tuple[float, torch.Tensor, int]]" = OrderedDict()
+        self._inflight: Dict[bytes, asyncio.Future] = {}
+        self._tasks: Set[asyncio.Task] = set()
+
+    @staticmethod
+    def key(raw_img_data: bytes) -> bytes:
+        return hashlib.blake2b(raw_img_data, digest_size=16).digest()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            **self.counts,
+            "evictions": self.evictions,
+            "entries": len(self._entries),
+            "size_bytes": self.size_bytes,
+        }
+
+    def _record(self, result: str):
+        self.counts[result] += 1
+        RESPONSE_CACHE_REQUESTS.labels(model_name=self.model_name, result=result).inc()
+
+    def get(self, key: bytes) -> Optional[torch.Tensor]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires, output, size = entry
+        if self.ttl and expires < time.monotonic():
+            del self._entries[key]
+            self.size_bytes -= size
+            return None
+        self._entries.move_to_end(key)
+        return output
+
+    def put(self, key: bytes, output: torch.Tensor):
+        # Store a copy, a row of the batch output would keep the whole batch alive.
+        output = output.clone()
+        size = output.element_size() * output.nelement() + len(key) + self.ENTRY_OVERHEAD
+        if size > self.max_bytes:
+            return
+        if key in self._entries:
+            self.size_bytes -= self._entries.pop(key)[2]
+        self._entries[key] = (time.monotonic() + self.ttl, output, size)
+        self.size_bytes += size
+        while self.size_bytes > self.max_bytes:
+            _, (_, _, evicted) = self._entries.popitem(last=False)
+            self.size_bytes -= evicted
+            self.evictions += 1
+
+    async def get_or_infer(
+        self,
+        raw_images: List[bytes],
+        infer: Callable[[List[bytes]], Awaitable[torch.Tensor]],
+    ) -> torch.Tensor:
+        """Return the outputs for raw_images, running infer only for the images
+        that are neither cached nor already being inferred."""
+        outputs: List[Optional[torch.Tensor]] = [None] * len(raw_images)
+        missing: Dict[bytes, List[int]] = {}
+        pending: List[Tuple[int, asyncio.Future]] = []
+        for i, raw_img_data in enumerate(raw_images):
+            key = self.key(raw_img_data)
+            output = self.get(key)
+            if output is not None:
+                self._record("hit")
+                outputs[i] = output
+            elif key in missing:
+                self._record("coalesced")
+                missing[key].append(i)
+            elif key in self._inflight:
+                self._record("coalesced")
+                pending.append((i, self._inflight[key]))
+            else:
+                self._record("miss")
+                missing[key] = [i]
+                self._inflight[key] = asyncio.get_running_loop().create_future()
+
+        if missing:
+            # The forward pass is shared with the requests coalesced onto it,
+            # it runs as a task of its own so that cancelling the request that
+            # started it does not cancel it for the others.
+            task = asyncio.ensure_future(self._infer_missing(
+                list(missing), [raw_images[indices[0]] for indices in missing.values()], infer
+            ))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+            for key, indices in missing.items():
+                pending.extend((i, self._inflight[key]) for i in indices)
+
+        deadline = REQUEST_DEADLINE.get()
+        for i, future in pending:
+            if deadline is None:
+                outputs[i] = await asyncio.shield(future)
+                continue
+            try:
+                outputs[i] = await asyncio.wait_for(
+                    asyncio.shield(future), max(deadline - time.monotonic(), 0)
+                )
+            except asyncio.TimeoutError:
+                raise DeadlineExpired("The request deadline passed before inference") from None
+        return torch.stack(outputs)
+
+    async def _infer_missing(
+        self,
+        keys: List[bytes],
+        raw_images: List[bytes],
+        infer: Callable[[List[bytes]], Awaitable[torch.Tensor]],
+    ):
+        # The task serves every request coalesced onto it, not only the one
+        # whose context it was created in, their deadlines are checked in
+        # get_or_infer.
+        REQUEST_DEADLINE.set(None)
+        REQUEST_PRIORITY.set(PRIORITIES[0])
+        try:
+            results = await infer(raw_images)
+        except asyncio.CancelledError:
+            for key in keys:
+                self._inflight.pop(key).cancel()
+            raise
+        except Exception as e:
+            for key in keys:
+                future = self._inflight.pop(key)
+                future.set_exception(e)
+                # Mark the exception as retrieved when nobody is waiting.
+                future.exception()
+            return
+        for key, output in zip(keys, results):
+            self.put(key, output)
+            self._inflight.pop(key).set_result(output)
+
+
+def _all_threads_config() -> Dict:
+    """Return the profiler arguments that record every thread of the process,
+    forward passes and decoding run on the executor's threads. The option is
+    only available in recent torch releases, older ones record the operators
+    of the thread that started the capture only, an empty dict is returned."""
+    try:
+        config = torch._C._profiler._ExperimentalConfig(profile_all_threads=True)
+    except (AttributeError, TypeError):
+        return {}
+    return {"experimental_config": config}
+
+
+class TorchProfiler:
+    """Records the next requests of a predictor with ``torch.profiler``.
+
+    A capture runs until ``max_requests`` predict calls finished or
+    ``max_seconds`` passed, whichever comes first, and records the operators
+    with their input shapes and Python stacks. Torch releases that can not
+    record every thread only record the event loop's, the work of the
+    ``executor`` then runs inline on the event loop for the capture.
+    While no capture runs the predictors only pay for the ``request_finished``
+    call, the profiler is not attached.
+    """
+
+    def __init__(self, row_limit: int = 20, executor: Optional[InferenceExecutor] = None):
+        self.row_limit = row_limit
+        self.executor = executor
+        self._done: Optional[asyncio.Event] = None
+        self._max_requests = 0
+        self._finished = 0
+
+    @property
+    def active(self) -> bool:
+        return self._done is not None
+
+    def request_finished(self):
+        if self._done is None:
+            return
+        self._finished += 1
+        if self._finished == self._max_requests:
+            self._done.set()
+
+    async def capture(self, max_requests: int, max_seconds: float) -> Tuple[Dict, bytes]:
+        """Run a capture and return the top operators summary and the gzipped
+        Chrome trace, which Perfetto and the TensorBoard profiler plugin open."""
+        if self.active:
+            raise RuntimeError("A profiler capture is already running")
+        self._done = asyncio.Event()
+        self._max_requests = max_requests
+        self._finished = 0
+        all_threads_config = _all_threads_config()
+        inline = not all_threads_config and self.executor is not None
+        if inline:
+            self.executor.inline = True
+        try:
+            profile = torch.profiler.profile(
+                activities=[torch.profiler.ProfilerActivity.CPU],
+                record_shapes=True,
+                with_stack=True,
+                **all_threads_config,
+            )
+            start = time.monotonic()
+            profile.start()
+            try:
+                await asyncio.wait_for(self._done.wait(), max_seconds)
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                profile.stop()
+        finally:
+            self._done = None
+            if inline:
+                self.executor.inline = False
+        seconds = time.monotonic() - start
+        summary, trace = await asyncio.get_running_loop().run_in_executor(
+            None, self._export, profile
+        )
+        summary.update({"requests": self._finished, "seconds": round(seconds, 3)})
+        return summary, trace
+
+    def _export(self, profile: torch.profiler.profile) -> Tuple[Dict, bytes]:
+        averages = profile.key_averages()
+        top = sorted(averages, key=lambda event: event.self_cpu_time_total, reverse=True)
+        summary = {
+            "top_operators": [
+                {
+                    "name": event.key,
+                    "count": event.count,
+                    "self_cpu_ms": round(event.self_cpu_time_total / 1000, 3),
+                    "cpu_total_ms": round(event.cpu_time_total / 1000, 3),
+                }
+                for event in top[:self.row_limit]
+            ],
+            "table": averages.table(sort_by="self_cpu_time_total", row_limit=self.row_limit),
+        }
+        fd, path = tempfile.mkstemp(suffix=".pt.trace.json")
+        os.close(fd)
+        try:
+            profile.export_chrome_trace(path)
+            with open(path, "rb") as trace_file:
+                trace = gzip.compress(trace_file.read(), compresslevel=1)
+        finally:
+            os.remove(path)
+        return summary, trace
+
+
+def profiler_router(
+    model_name: str,
+    capture: Callable[[int, float], Awaitable[Tuple[Dict, bytes]]],
+    token: str,
+    max_seconds: float = 300,
+) -> APIRouter:
+    """Return the admin routes of a predictor's profiler.
+
+    ``POST /admin/profile?requests=N&seconds=T`` records the next N requests
+    or T seconds with ``capture`` and responds with the top operators, the
+    trace is then downloaded from ``GET /admin/profile/trace``. Both routes
+    require an ``Authorization: Bearer <token>`` header.
+    """
+    router = APIRouter()
+    traces: Dict[str, bytes] = {}
+
+    def authorize(request: Request):
+        expected = f"Bearer {token}".encode()
+        given = request.headers.get("authorization", "").encode()
+        if not hmac.compare_digest(given, expected):
+            raise HTTPException(status_code=401, detail="Invalid profiler token")
+
+    async def profile(request: Request, requests: int = 0, seconds: float = 10):
+        authorize(request)
+        if requests < 0 or not 0 < seconds <= max_seconds:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Expected requests >= 0 and 0 < seconds <= {max_seconds}",
+            )
+        try:
+            summary, traces["last"] = await capture(requests, seconds)
+        except RuntimeError as e:
+            raise HTTPException(status_code=409, detail=str(e))
+        return summary
+
+    async def trace(request: Request):
+        authorize(request)
+        if "last" not in traces:
+            raise HTTPException(status_code=404, detail="No profiler capture yet")
+        return Response(
+            traces["last"],
+            media_type="application/gzip",
+            headers={
+                "content-disposition": f'attachment; filename="{model_name}.pt.trace.json.gz"'
+            },
+        )
+
+    router.add_api_route("/admin/profile", profile, methods=["POST"])
+    router.add_api_route("/admin/profile/trace", trace, methods=["GET"])
+    return router
+
+
+# The InferencePipeline arguments set from the command line of the examples.
+PIPELINE_OPTIONS = [
+    "model_path",
+    "executor_mode",
+    "executor_workers",
+    "max_concurrent_inference",
+    "image_decoder",
+    "max_image_pixels",
+    "intra_op_threads",
+    "inter_op_threads",
+    "tune_threads",
+    "response_cache_bytes",
+    "response_cache_ttl_seconds",
+    "dynamic_quantization",
+    "execution_mode",
+    "compile_cache_dir",
+    "warm_up_batch_sizes",
+    "max_queue_delay_ms",
+    "bulk_batch_size",
+    "bulk_batch_latency_ms",
+]
+
+
+def pipeline_parser() -> argparse.ArgumentParser:
+    """Return a parent parser with the arguments of InferencePipeline, see
+    pipeline_options, and --profiler_token_file."""
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument(
+        "--model_path",
+        default=None,
+        help="A local state_dict saved with torch.save, which is memory-mapped "
+        "instead of downloading the pretrained weights.",
+    )
+    parser.add_argument(
+        "--executor_mode",
+        default="thread",
+        choices=EXECUTOR_MODES,
+        help="Where image decoding and forward passes run: 'inline' on the event loop, "
+        "'thread' on a thread pool or 'process' to also decode on a process pool.",
+    )
+    parser.add_argument(
+        "--executor_workers",
+        default=1,
+        type=int,
+        help="The number of threads or processes of the inference executor, the "
+        "default of 1 decodes the images of a batch one after the other.",
+    )
+    parser.add_argument(
+        "--max_concurrent_inference",
+        default=0,
+        type=int,
+        help="The max number of forward passes in flight, 0 means unbounded.",
+    )
+    parser.add_argument(
+        "--image_decoder",
+        default="pil",
+        choices=IMAGE_DECODERS,
+        help="How images are decoded: 'pil' at full resolution, 'pil-draft' with JPEG "
+        "DCT scaling down to about the resize size or 'torchvision' with torchvision.io.",
+    )
+    parser.add_argument(
+        "--max_image_pixels",
+        default=64_000_000,
+        type=int,
+        help="Images with more pixels are rejected before they are decoded.",
+    )
+    parser.add_argument(
+        "--intra_op_threads",
+        default=0,
+        type=int,
+        help="The torch intra-op threads of every forward pass, 0 splits the CPU limit "
+        "between the workers and the concurrent forward passes of the executor.",
+    )
+    parser.add_argument(
+        "--inter_op_threads",
+        default=1,
+        type=int,
+        help="The torch inter-op threads, AlexNet runs its operators sequentially.",
+    )
+    parser.add_argument(
+        "--tune_threads",
+        action="store_true",
+        help="Time forward passes with up to --intra_op_threads threads at startup "
+        "and use the fastest setting.",
+    )
+    parser.add_argument(
+        "--response_cache_bytes",
+        default=0,
+        type=int,
+        help="The memory bound of the LRU cache of outputs for repeated images, "
+        "0 disables the cache.",
+    )
+    parser.add_argument(
+        "--response_cache_ttl_seconds",
+        default=0,
+        type=float,
+        help="How long cached outputs are served, 0 means until they are evicted.",
+    )
+    parser.add_argument(
+        "--dynamic_quantization",
+        action="store_true",
+        help="Quantize the weights of the Linear layers to int8 for faster CPU inference.",
+    )
+    parser.add_argument(
+        "--execution_mode",
+        default="eager",
+        choices=EXECUTION_MODES,
+        help="How forward passes run: 'eager', 'script' with TorchScript or 'compile' "
+        "with torch.compile.",
+    )
+    parser.add_argument(
+        "--compile_cache_dir",
+        default=None,
+        help="A local directory the scripted model or the torch.compile kernels are "
+        "saved to, so that restarts reuse them instead of compiling again.",
+    )
+    parser.add_argument(
+        "--warm_up_batch_sizes",
+        default=[1],
+        type=int,
+        nargs="*",
+        help="The batch sizes of the forward passes run before the model reports ready.",
+    )
+    parser.add_argument(
+        "--max_queue_delay_ms",
+        default=0,
+        type=float,
+        help="Reject requests while the estimated queue delay exceeds this budget, "
+        "with 429 or RESOURCE_EXHAUSTED. 0 disables load shedding.",
+    )
+    parser.add_argument(
+        "--profiler_token_file",
+        default=None,
+        help="A file holding the bearer token of the /admin/profile route, which "
+        "records requests with torch.profiler. The route is disabled when unset.",
+    )
+    parser.add_argument(
+        "--bulk_batch_size",
+        default=32,
+        type=int,
+        help="The max number of bulk priority requests grouped into one forward pass. "
+        "Bulk requests are not batched when set to 1.",
+    )
+    parser.add_argument(
+        "--bulk_batch_latency_ms",
+        default=50.0,
+        type=float,
+        help="The max time in milliseconds a bulk request waits for a batch to fill up.",
+    )
+    return parser
+
+
+def worker_parser() -> argparse.ArgumentParser:
+    """Return a parent parser with the arguments about loading the model in
+    the model server process and its --workers processes."""
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument(
+        "--background_load",
+        action="store_true",
+        help="Start serving liveness probes right away and load the model in the "
+        "background, the model reports ready after a warm-up inference.",
+    )
+    parser.add_argument(
+        "--share_weights",
+        action="store_true",
+        help="Let the --workers processes memory-map a single copy of the weights "
+        "instead of each holding their own.",
+    )
+    return parser
+
+
+def grpc_parser() -> argparse.ArgumentParser:
+    """Return a parent parser with the arguments of the gRPC servers."""
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument(
+        "--stream_port",
+        default=0,
+        type=int,
+        help="The port of the ModelStreamInfer bidirectional streaming RPC, which "
+        "batches the frames of a stream as they arrive. 0 disables it.",
+    )
+    parser.add_argument(
+        "--stream_batch_size",
+        default=8,
+        type=int,
+        help="The max number of stream messages inferred as one batch, as many are "
+        "read ahead before the stream is paused.",
+    )
+    parser.add_argument(
+        "--grpc_compression",
+        default="none",
+        choices=list(GRPC_COMPRESSION),
+        help="Compress the gRPC responses for the clients that accept it.",
+    )
+    parser.add_argument(
+        "--grpc_keepalive_ms",
+        default=0,
+        type=int,
+        help="Ping idle gRPC connections, and accept client pings, every so many "
+        "milliseconds. 0 keeps the gRPC defaults.",
+    )
+    parser.add_argument(
+        "--grpc_window_bytes",
+        default=0,
+        type=int,
+        help="A fixed HTTP/2 flow control window per gRPC stream, 0 sizes it from "
+        "the bandwidth-delay product of the connection.",
+    )
+    return parser
+
+
+def pipeline_options(args: argparse.Namespace) -> Dict[str, Any]:
+    """Return the InferencePipeline arguments parsed with pipeline_parser."""
+    return {name: getattr(args, name) for name in PIPELINE_OPTIONS}
+
+
+class InferencePipeline:
+    """Loads a torchvision model and runs its forward passes on an
+    ``InferenceExecutor``, for the predictors of the custom predictor examples.
+    ``infer_images`` decodes and preprocesses encoded images on the executor
+    and runs them through the model as one batch, the outputs of repeated
+    images are served from a ``ResponseCache`` when enabled. With ``max_batch_size``
+    greater than 1 concurrent forward passes are grouped into batches, bulk
+    priority requests in batches of their own. The
+    CPUs of the container, or ``cpus``, are split between the forward passes
+    that run concurrently in all ``processes`` of the model server. The stages
+    of requests are recorded with ``metrics``, e.g. ``RayMetrics``, instead of
+    the prometheus metrics of the model server when given. ``request`` admits
+    a request through the ``LoadShedder`` and times its stages, the
+    ``TorchProfiler`` records requests on demand.
+
+    ``load`` builds the model, from the pretrained weights or memory-mapped
+    from ``model_path``, quantizes, scripts or compiles it and warms it up. With
+    ``share_weights``, or a quantized, scripted or compiled model, which do not
+    pickle, the pipeline is pickled without the model, e.g. into the --workers
+    processes of the model server, which load it again.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        model_fn: Callable[..., torch.nn.Module],
+        model_path: Optional[str] = None,
+        dynamic_quantization: bool = False,
+        execution_mode: str = "eager",
+        compile_cache_dir: Optional[str] = None,
+        warm_up_batch_sizes: Sequence[int] = (1,),
+        share_weights: bool = False,
+        executor_mode: str = "thread",
+        executor_workers: int = 1,
+        max_concurrent_inference: int = 0,
+        max_batch_size: int = 1,
+        max_batch_latency_ms: float = 5.0,
+        image_decoder: str = "pil",
+        max_image_pixels: int = 64_000_000,
+        intra_op_threads: int = 0,
+        inter_op_threads: int = 1,
+        tune_threads: bool = False,
+        processes: int = 1,
+        cpus: Optional[int] = None,
+        response_cache_bytes: int = 0,
+        response_cache_ttl_seconds: float = 0,
+        metrics: Optional[RayMetrics] = None,
+        max_queue_delay_ms: float = 0,
+        bulk_batch_size: int = 32,
+        bulk_batch_latency_ms: float = 50.0,
+    ):
+        self.name = name
+        self.model_fn = model_fn
+        self.model_path = model_path
+        self.share_weights = share_weights
+        if share_weights and not model_path:
+            # The pretrained weights are written to a file once for all workers
+            self.model_path = export_weights(model_fn(pretrained=True))
+        self.dynamic_quantization = dynamic_quantization
+        self.execution_mode = execution_mode
+        self.compile_cache_dir = compile_cache_dir
+        self.warm_up_batch_sizes = warm_up_batch_sizes
+        self.metrics = metrics
+        self.model = None
+        self.preprocessor = ImagePreprocessor(decoder=image_decoder, max_image_pixels=max_image_pixels)
+        self.executor = InferenceExecutor(executor_mode, executor_workers, max_concurrent_inference)
+        # The CPUs of the container, or cpus, are split between the model server
+        # processes and the forward passes each of them runs concurrently.
+        if intra_op_threads == 0:
+            intra_op_threads = thread_budget(processes, self.executor.concurrency, cpus)
+        self.intra_op_threads = intra_op_threads
+        self.inter_op_threads = inter_op_threads
+        self.tune_threads = tune_threads
+        set_torch_threads(intra_op_threads, inter_op_threads)
+        # Outputs of repeated images are served from an LRU cache when enabled.
+        self.cache = None
+        if response_cache_bytes > 0:
+            self.cache = ResponseCache(name, response_cache_bytes, response_cache_ttl_seconds)
+        # Concurrent requests are grouped into a single forward pass when
+        # dynamic batching is enabled with max_batch_size > 1. Bulk requests
+        # are batched separately, in larger batches that wait longer to fill up.
+        self.batchers = PriorityBatchers(self.infer)
+        if max_batch_size > 1:
+            self.batchers.add("interactive", max_batch_size, max_batch_latency_ms)
+        if bulk_batch_size > 1:
+            self.batchers.add("bulk", bulk_batch_size, bulk_batch_latency_ms)
+        # Requests are dropped once their deadline passed and rejected while the
+        # estimated queue delay exceeds max_queue_delay_ms.
+        self.shedder = LoadShedder(
+            name, self.executor, max_queue_delay_ms, on_shed=None if metrics is None else metrics.shed
+        )
+        # Captures of the admin profiler route, idle until one is requested.
+        self.profiler = TorchProfiler(executor=self.executor)
+
+    def load(self):
+        # The model is built in a local variable and only published once it
+        # is warmed up, requests never see a half-built model.
+        if self.model_path:
+            model = load_mmap_weights(self.model_fn, self.model_path)
+        else:
+            model = self.model_fn(pretrained=True)
+        model.eval()
+        if self.dynamic_quantization:
+            model = quantize_dynamic_int8(model)
+        model = optimize_model(
+            model,
+            self.execution_mode,
+            self.compile_cache_dir,
+            artifact_key(self.model_path, self.dynamic_quantization),
+        )
+
+        def forward(input_batch: torch.Tensor) -> torch.Tensor:
+            with torch.inference_mode():
+                return model(input_batch)
+
+        # The first forward passes select kernels, grow the allocator and, with
+        # torch.compile, compile the model, run them before reporting ready.
+        for batch_size in self.warm_up_batch_sizes:
+            forward(torch.zeros(batch_size, 3, 224, 224))
+        if self.tune_threads:
+            # The sweep runs once, the workers of the model server inherit its result.
+            batch_size = max(self.warm_up_batch_sizes, default=1)
+            self.intra_op_threads = sweep_threads(
+                forward, torch.zeros(batch_size, 3, 224, 224), self.intra_op_threads
+            )
+            self.tune_threads = False
+        self.model = model
+
+    def __getstate__(self):
+        # The model server pickles the model into each of its --workers
+        # processes. With share_weights they memory-map the weights file again
+        # instead of unpickling a copy, the page cache holds a single copy of
+        # the weights for all of them. Quantized, scripted and compiled models
+        # can not be pickled, they are built again in each process.
+        state = self.__dict__.copy()
+        if self.share_weights or self.dynamic_quantization or self.execution_mode != "eager":
+            state["model"] = None
+            state["reload"] = self.model is not None
+        return state
+
+    def __setstate__(self, state):
+        reload = state.pop("reload", False)
+        self.__dict__.update(state)
+        set_torch_threads(self.intra_op_threads, self.inter_op_threads)
+        if reload:
+            self.load()
+
+    def forward(self, input_batch: torch.Tensor) -> torch.Tensor:
+        with torch.inference_mode():
+            return self.model(input_batch)
+
+    def observe(self, timer: StageTimer, priority: Optional[str] = None):
+        """Record the stages of a request with the metrics of the pipeline, or
+        the prometheus metrics of the model server."""
+        if self.metrics is None:
+            timer.observe(self.name, priority)
+        else:
+            self.metrics.observe(timer, priority)
+
+    @contextmanager
+    def request(
+        self, headers: Optional[Dict[str, str]], from_grpc: bool = False
+    ) -> Iterator[StageTimer]:
+        """Admit a request with the deadline and priority class of its headers
+        and yield the timer of its stages, which are recorded when it succeeded."""
+        priority = request_priority(headers)
+        with self.shedder.admit(request_deadline(headers), from_grpc, priority):
+            timer = StageTimer()
+            yield timer
+            self.observe(timer, priority)
+            self.profiler.request_finished()
+
+    async def load_in_background(self):
+        """Load the model off the event loop and run a warm-up inference
+        through the whole pipeline."""
+        await asyncio.get_running_loop().run_in_executor(None, self.load)
+        await self._infer_images([warm_up_image()])
+
+    async def infer(self, input_batch: torch.Tensor) -> torch.Tensor:
+        return await self.executor.forward(self.forward, input_batch)
+
+    async def submit(self, input_batch: torch.Tensor) -> torch.Tensor:
+        """Run a preprocessed batch through the model, with the batch of the
+        request's priority class if it has one."""
+        return await self.batchers.submit(input_batch)
+
+    async def infer_images(
+        self, raw_images: List[bytes], timer: Optional[StageTimer] = None
+    ) -> torch.Tensor:
+        if self.cache is not None:
+            return await self.cache.get_or_infer(
+                raw_images, lambda missing: self._infer_images(missing, timer)
+            )
+        return await self._infer_images(raw_images, timer)
+
+    async def _infer_images(
+        self, raw_images: List[bytes], timer: Optional[StageTimer] = None
+    ) -> torch.Tensor:
+        timer = timer or StageTimer()
+        # All images are preprocessed and run through the model as one batch
+        results = await asyncio.gather(*[
+            self.executor.decode(self.preprocessor.timed, raw_img_data)
+            for raw_img_data in raw_images
+        ])
+        for _, decode_seconds, transform_seconds in results:
+            timer.add("image_decode", decode_seconds)
+            timer.add("transform", transform_seconds)
+        input_tensor = torch.stack([tensor for tensor, _, _ in results])
+        # With dynamic batching this includes the wait for the batch to fill up.
+        with timer.stage("forward"):
+            return await self.submit(input_tensor)
+
+
+def grpc_options(
+    max_send_message_length: int,
+    max_receive_message_length: int,
+    compression: str = "none",
+    keepalive_ms: int = 0,
+    window_bytes: int = 0,
+) -> List[Tuple[str, Any]]:
+    """Return the options of the gRPC servers.
+
+    Responses are compressed for the clients that accept the compression.
+    With keepalive_ms the server pings idle connections, and lets clients ping
+    as often, so that connections through idle-timing load balancers stay
+    open. window_bytes sets a fixed HTTP/2 flow control window per stream
+    instead of sizing it from the bandwidth-delay product of the connection.
+    """
+    options = [
+        ("grpc.max_send_message_length", max_send_message_length),
+        ("grpc.max_receive_message_length", max_receive_message_length),
+        ("grpc.default_compression_algorithm", GRPC_COMPRESSION[compression]),
+    ]
+    if keepalive_ms:
+        options += [
+            ("grpc.keepalive_time_ms", keepalive_ms),
+            ("grpc.keepalive_timeout_ms", 20_000),
+            ("grpc.keepalive_permit_without_calls", 1),
+            ("grpc.http2.min_recv_ping_interval_without_data_ms", keepalive_ms),
+        ]
+    if window_bytes:
+        options += [
+            ("grpc.http2.lookahead_bytes", window_bytes),
+            ("grpc.http2.bdp_probe", 0),
+        ]
+    return options
+
+
+class TunedGRPCServer(GRPCServer):
+    """The KServe gRPC server with the given server options, KServe only sets
+    the max message lengths, and the deadlines of the calls passed on."""
+
+    def __init__(self, *args, options: Sequence[Tuple[str, Any]] = (), **kwargs):
+        super().__init__(*args, **kwargs)
+        self.options = list(options)
+
+    async def start(self, max_workers):
+        inference_servicer = DeadlineServicer(
+            self._data_plane, self._model_repository_extension
+        )
+        self._server = grpc.aio.server(
+            ThreadPoolExecutor(max_workers=max_workers),
+            interceptors=(LoggingInterceptor(), ExceptionToStatusInterceptor()),
+            options=self.options,
+        )
+        grpc_predict_v2_pb2_grpc.add_GRPCInferenceServiceServicer_to_server(
+            inference_servicer, self._server
+        )
+        listen_addr = f"[::]:{self._port}"
+        self._server.add_insecure_port(listen_addr)
+        logger.info("Starting gRPC server on %s with options %s", listen_addr, self.options)
+        await self._server.start()
+        await self._server.wait_for_termination()
+
+class StreamServer:
+    """Serves the ModelStreamInfer bidirectional streaming RPC of a pipeline
+    on a gRPC server of its own, the KServe gRPC server only serves unary
+    calls.
+
+    Every message carries one or more encoded frames as a BYTES input and is
+    answered with a response of the same id, in order. The frames of the
+    messages that arrived while a batch was inferred form the next one, up to
+    ``batch_size`` messages.
+    """
+
+    def __init__(
+        self,
+        pipeline: InferencePipeline,
+        port: int,
+        batch_size: int = 8,
+        options: Sequence[Tuple[str, Any]] = (),
+    ):
+        self.pipeline = pipeline
+        self.port = port
+        self.batch_size = batch_size
+        self.options = list(options)
+        self.server = None
+
+    def __getstate__(self):
+        # The streaming server only runs in the main process.
+        state = self.__dict__.copy()
+        state["server"] = None
+        return state
+
+    async def serve(self):
+        self.server = grpc.aio.server(options=self.options)
+        handler = grpc.stream_stream_rpc_method_handler(
+            self.stream_infer,
+            request_deserializer=ModelInferRequest.FromString,
+            response_serializer=ModelInferResponse.SerializeToString,
+        )
+        self.server.add_generic_rpc_handlers((
+            grpc.method_handlers_generic_handler(STREAM_SERVICE, {STREAM_METHOD: handler}),
+        ))
+        self.server.add_insecure_port(f"[::]:{self.port}")
+        await self.server.start()
+        logger.info("Serving %s/%s on port %s", STREAM_SERVICE, STREAM_METHOD, self.port)
+        await self.server.wait_for_termination()
+
+    def stop(self):
+        if self.server is not None:
+            # Streams in progress get a few seconds to finish.
+            asyncio.create_task(self.server.stop(5))
+
+    async def stream_infer(
+        self,
+        messages: AsyncIterator[ModelInferRequest],
+        context: grpc.aio.ServicerContext,
+    ) -> AsyncIterator[ModelInferResponse]:
+        pipeline = self.pipeline
+        if pipeline.model is None:
+            await context.abort(grpc.StatusCode.UNAVAILABLE, f"Model {pipeline.name} is not ready")
+        # The priority class of the stream is set once, with its metadata.
+        try:
+            REQUEST_PRIORITY.set(request_priority(dict(context.invocation_metadata() or ())))
+        except InvalidInput as e:
+            await context.abort(grpc.StatusCode.INVALID_ARGUMENT, str(e))
+        async for batch in batches_on_arrival(messages, self.batch_size, self.batch_size):
+            timer = StageTimer()
+            payloads = [InferRequest.from_grpc(message) for message in batch]
+            try:
+                frames = []
+                for payload in payloads:
+                    if payload.inputs[0].datatype != "BYTES":
+                        raise InvalidInput(
+                            f"Expected a BYTES input, got {payload.inputs[0].datatype}"
+                        )
+                    frames.append(bytes_input(payload.inputs[0]))
+                output = await pipeline.infer_images(
+                    [frame for images in frames for frame in images], timer
+                )
+            except InvalidInput as e:
+                await context.abort(grpc.StatusCode.INVALID_ARGUMENT, str(e))
+            with timer.stage("postprocess"):
+                torch.nn.functional.softmax(output, dim=1)
+                values, top_5 = torch.topk(output, 5)
+            with timer.stage("response"):
+                responses = [
+                    fp32_response(payload, rows, pipeline.name)
+                    for payload, rows in zip(
+                        payloads, values.split([len(images) for images in frames])
+                    )
+                ]
+            timer.observe(pipeline.name)
+            server_timing = timer.server_timing()
+            for response in responses:
+                response.parameters = {"server_timing": server_timing}
+                # Waits while the client is not reading, which in turn pauses
+                # the reads of the next frames.
+                yield response.to_grpc()
+                pipeline.profiler.request_finished()